@@ -6,9 +6,36 @@
 
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, colorchooser
-from PIL import Image, ImageTk, ImageDraw, ImageFont
+from PIL import ImageTk
 import os
 import json
+import queue
+
+import watermark_engine
+import watermark_export
+import watermark_listview
+import watermark_manifest
+import watermark_prefetch
+import watermark_project
+import watermark_scan
+import watermark_trace
+
+# 预览重绘间隔（毫秒，约60帧/秒），同一帧内的多次重绘请求合并为一次
+PREVIEW_FRAME_MS = 16
+# 交互停止多久后进行一次高质量重绘（毫秒）
+PREVIEW_IDLE_MS = 200
+# 后台预读当前图片前后各多少张
+PREFETCH_RADIUS = 3
+# 文件夹导入时轮询扫描结果的间隔（毫秒）
+IMPORT_POLL_MS = 50
+# 导出格式选项（界面显示名称 -> 输出格式，None为保持原图格式）
+OUTPUT_FORMAT_CHOICES = {"保持原格式": None, "JPEG": 'jpeg', "PNG": 'png', "WebP": 'webp', "TIFF": 'tiff'}
+# 编码预设选项（界面显示名称 -> 预设名称，None为默认设置）
+ENCODER_PRESET_CHOICES = {"默认": None, "快速": 'fast', "均衡": 'balanced', "最小文件": 'smallest'}
+# 导出时轮询进度事件的间隔（毫秒）
+EXPORT_POLL_MS = 100
+# 项目修改的提交间隔（毫秒），期间的多次修改合并为一次提交
+PROJECT_COMMIT_MS = 1000
 
 class WorkingWatermarkApp:
     def __init__(self, root):
@@ -18,20 +45,36 @@ class WorkingWatermarkApp:
         self.root.minsize(1200, 700)
         
         # 数据存储
-        self.images = []
         self.current_image_index = 0
-        self.current_image = None
-        
-        # 每张图片的独立水印配置
-        self.image_watermark_configs = {}  # 每张图片的独立水印配置
-        self.default_watermark_config = {
-            'text': '水印文字',
-            'font_size': 24,
-            'font_color': (255, 0, 0),
-            'opacity': 80,
-            'position': (50, 50),
-            'rotation': 0
-        }
+        self.current_image = None  # 预览用图片（JPEG可能按缩小分辨率解码）
+        self.current_image_size = None  # 原图尺寸，用于水印位置计算
+        self.scanners = []  # 正在进行的后台文件夹扫描
+        self.import_after_id = None
+        self.export_job = None  # 正在进行的后台导出
+        self.export_errors = []
+        
+        # 预览代理图：按画布尺寸缩小后的当前图片，只在图片或画布尺寸变化时重建
+        self.preview_proxy = None
+        self.preview_proxy_scale = 1.0
+        self.preview_proxy_key = None
+        
+        # 后台预读相邻图片
+        self.prefetcher = watermark_prefetch.PreviewPrefetcher(radius=PREFETCH_RADIUS)
+        
+        # 预览重绘调度：快速预览时水印作为单独的画布图层，停止交互后再完整合成
+        self.preview_mode = None
+        self.redraw_after_id = None
+        self.idle_after_id = None
+        self.full_redraw_pending = False
+        self.proxy_photo = None
+        self.proxy_photo_source = None
+        self.overlay_photo = None
+        self.overlay_key = None
+        
+        # 项目：图片列表（按需从数据库读取）、导入时探测到的文件头信息和每张图片的独立水印配置
+        # （共享模板，每张图片只保存修改过的字段）；未保存的项目在内存中
+        self.default_watermark_config = watermark_engine.DEFAULT_WATERMARK_CONFIG.copy()
+        self.set_project(watermark_project.Project(default_config=self.default_watermark_config))
         self.watermark_config = self.default_watermark_config.copy()  # 当前显示的水印配置
         
         # 模板系统
@@ -40,6 +83,8 @@ class WorkingWatermarkApp:
         self.load_templates()
         
         self.create_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(PROJECT_COMMIT_MS, self.commit_project)
         
     def create_widgets(self):
         """创建主界面"""
@@ -90,6 +135,13 @@ class WorkingWatermarkApp:
         frame = ttk.LabelFrame(parent, text="文件处理", padding=10)
         frame.pack(fill=tk.X, pady=(0, 10))
         
+        # 项目按钮
+        project_frame = ttk.Frame(frame)
+        project_frame.pack(fill=tk.X, pady=(0, 5))
+        ttk.Button(project_frame, text="新建项目", command=self.new_project).pack(side=tk.LEFT, expand=True, fill=tk.X)
+        ttk.Button(project_frame, text="打开项目", command=self.open_project).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=5)
+        ttk.Button(project_frame, text="保存项目", command=self.save_project).pack(side=tk.LEFT, expand=True, fill=tk.X)
+        
         # 导入按钮
         ttk.Button(frame, text="导入图片", command=self.import_images).pack(fill=tk.X, pady=(0, 5))
         ttk.Button(frame, text="导入文件夹", command=self.import_folder).pack(fill=tk.X, pady=(0, 5))
@@ -98,14 +150,10 @@ class WorkingWatermarkApp:
         list_frame = ttk.Frame(frame)
         list_frame.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
         
-        self.image_listbox = tk.Listbox(list_frame, height=6)
-        scrollbar = ttk.Scrollbar(list_frame, orient=tk.VERTICAL, command=self.image_listbox.yview)
-        self.image_listbox.configure(yscrollcommand=scrollbar.set)
-        
-        self.image_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        self.image_listbox.bind('<<ListboxSelect>>', self.on_image_select)
+        # 虚拟化列表：只生成可见行，支持大量图片
+        self.image_list = watermark_listview.VirtualListView(list_frame, self.image_row_text, height=6,
+                                                             on_select=self.on_image_select)
+        self.image_list.pack(fill=tk.BOTH, expand=True)
         
     def create_watermark_panel(self, parent):
         """创建水印设置面板"""
@@ -152,6 +200,16 @@ class WorkingWatermarkApp:
                                  orient=tk.HORIZONTAL, command=self.update_watermark)
         rotation_scale.pack(fill=tk.X)
         
+        # 平铺水印（整张图片重复排列，拖拽时移动整个平铺图案）
+        self.tiled_var = tk.BooleanVar(value=self.watermark_config['tiled'])
+        ttk.Checkbutton(frame, text="平铺水印", variable=self.tiled_var,
+                        command=self.update_watermark).pack(anchor=tk.W, pady=(5, 0))
+        ttk.Label(frame, text="平铺间距:").pack(anchor=tk.W)
+        self.tile_spacing_var = tk.IntVar(value=self.watermark_config['tile_spacing'])
+        tile_spacing_scale = ttk.Scale(frame, from_=0, to=1000, variable=self.tile_spacing_var,
+                                     orient=tk.HORIZONTAL, command=self.update_watermark)
+        tile_spacing_scale.pack(fill=tk.X)
+        
     def create_position_panel(self, parent):
         """创建位置设置面板"""
         frame = ttk.LabelFrame(parent, text="位置设置", padding=10)
@@ -222,8 +280,42 @@ class WorkingWatermarkApp:
         self.folder_label = ttk.Label(frame, text="未选择", foreground="gray")
         self.folder_label.pack(anchor=tk.W)
         
+        # 输出格式
+        ttk.Label(frame, text="输出格式:").pack(anchor=tk.W, pady=(5, 0))
+        self.output_format_var = tk.StringVar(value=next(iter(OUTPUT_FORMAT_CHOICES)))
+        ttk.Combobox(frame, textvariable=self.output_format_var, values=list(OUTPUT_FORMAT_CHOICES),
+                     state="readonly").pack(fill=tk.X)
+        
+        # 编码预设（选择预设时同步质量滑块）
+        ttk.Label(frame, text="编码预设:").pack(anchor=tk.W, pady=(5, 0))
+        self.encoder_preset_var = tk.StringVar(value=next(iter(ENCODER_PRESET_CHOICES)))
+        preset_combo = ttk.Combobox(frame, textvariable=self.encoder_preset_var,
+                                    values=list(ENCODER_PRESET_CHOICES), state="readonly")
+        preset_combo.pack(fill=tk.X)
+        preset_combo.bind('<<ComboboxSelected>>', self.on_encoder_preset_select)
+        
+        # JPEG/WebP质量
+        self.export_quality_var = tk.IntVar(value=watermark_engine.DEFAULT_EXPORT_SETTINGS['quality'])
+        self.export_quality_label = ttk.Label(frame, text=f"质量: {self.export_quality_var.get()}")
+        self.export_quality_label.pack(anchor=tk.W, pady=(5, 0))
+        ttk.Scale(frame, from_=1, to=100, variable=self.export_quality_var, orient=tk.HORIZONTAL,
+                  command=lambda value: self.export_quality_label.config(
+                      text=f"质量: {self.export_quality_var.get()}")).pack(fill=tk.X)
+        
         # 导出按钮
-        ttk.Button(frame, text="导出所有图片", command=self.export_all).pack(fill=tk.X, pady=(10, 0))
+        export_btn_frame = ttk.Frame(frame)
+        export_btn_frame.pack(fill=tk.X, pady=(10, 0))
+        self.export_button = ttk.Button(export_btn_frame, text="导出所有图片", command=self.export_all)
+        self.export_button.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.cancel_export_button = ttk.Button(export_btn_frame, text="取消导出", command=self.cancel_export,
+                                               state=tk.DISABLED)
+        self.cancel_export_button.pack(side=tk.LEFT, padx=(5, 0))
+        
+        # 导出进度
+        self.export_progress = ttk.Progressbar(frame, mode='determinate')
+        self.export_progress.pack(fill=tk.X, pady=(5, 0))
+        self.export_status_label = ttk.Label(frame, text="", foreground="gray")
+        self.export_status_label.pack(anchor=tk.W)
         
     def create_preview_panel(self, parent):
         """创建预览面板"""
@@ -238,6 +330,7 @@ class WorkingWatermarkApp:
         self.preview_canvas.bind("<Button-1>", self.on_canvas_click)
         self.preview_canvas.bind("<B1-Motion>", self.on_canvas_drag)
         self.preview_canvas.bind("<ButtonRelease-1>", self.on_canvas_release)
+        self.preview_canvas.bind("<Configure>", self.on_canvas_resize)
         
         # 拖拽状态
         self.dragging = False
@@ -273,38 +366,162 @@ class WorkingWatermarkApp:
         
         files = filedialog.askopenfilenames(title="选择图片文件", filetypes=filetypes)
         if files:
+            start = len(self.images)
             self.images.extend(files)
-            self.update_image_list()
-            if len(self.images) == len(files):  # 第一次导入
+            self.append_image_rows(start)
+            if start == 0:  # 第一次导入
                 self.current_image_index = 0
                 self.load_current_image()
     
     def import_folder(self):
-        """导入文件夹"""
+        """导入文件夹（后台扫描，边扫描边显示）"""
         folder = filedialog.askdirectory(title="选择图片文件夹")
         if folder:
-            supported_formats = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff')
-            for root, dirs, files in os.walk(folder):
-                for file in files:
-                    if file.lower().endswith(supported_formats):
-                        self.images.append(os.path.join(root, file))
-            self.update_image_list()
-            if self.images and self.current_image_index == 0:
+            scanner = watermark_scan.FolderScanner(folder).start()
+            self.scanners.append(scanner)
+            if self.import_after_id is None:
+                self.import_after_id = self.root.after(IMPORT_POLL_MS, self.poll_import)
+    
+    def poll_import(self):
+        """把后台扫描到的图片逐批加入列表"""
+        self.import_after_id = None
+        start = len(self.images)
+        for scanner in list(self.scanners):
+            try:
+                while True:
+                    batch = scanner.results.get_nowait()
+                    if batch is None:
+                        self.scanners.remove(scanner)
+                        if scanner.skipped:
+                            watermark_trace.event("import.skipped", folder=scanner.folder, count=scanner.skipped)
+                        break
+                    self.images.extend(batch)
+            except queue.Empty:
+                pass
+        
+        if len(self.images) > start:
+            self.append_image_rows(start)
+            # 扫描到第一张图片后立即显示，不等待扫描结束
+            if self.current_image is None:
+                self.current_image_index = start
                 self.load_current_image()
+        
+        if self.scanners:
+            scanned = sum(scanner.found for scanner in self.scanners)
+            self.image_info_label.config(text=f"正在扫描: 已找到 {scanned} 张图片")
+            self.import_after_id = self.root.after(IMPORT_POLL_MS, self.poll_import)
+        else:
+            self.update_image_info()
+    
+    def set_project(self, project):
+        """切换到项目（图片列表和水印配置都来自项目）"""
+        self.project = project
+        self.images = project.images
+        self.image_watermark_configs = project.configs
+    
+    def new_project(self):
+        """新建空项目（内存中，保存时写入文件）"""
+        if not self.confirm_discard_project():
+            return
+        self.switch_project(watermark_project.Project(default_config=self.default_watermark_config))
+    
+    def open_project(self):
+        """打开项目文件（只读取行数，图片和配置在显示时读取）"""
+        if not self.confirm_discard_project():
+            return
+        path = filedialog.askopenfilename(title="打开项目",
+                                          filetypes=[("水印项目", f"*{watermark_project.PROJECT_SUFFIX}")])
+        if not path:
+            return
+        try:
+            project = watermark_project.Project(path, default_config=self.default_watermark_config)
+        except Exception as e:
+            messagebox.showerror("错误", f"无法打开项目: {e}")
+            return
+        self.switch_project(project)
+    
+    def save_project(self):
+        """保存项目；已保存过的项目修改会自动写入，这里只需立即提交"""
+        if self.project.is_saved:
+            self.project.commit()
+            return
+        path = filedialog.asksaveasfilename(title="保存项目", defaultextension=watermark_project.PROJECT_SUFFIX,
+                                            filetypes=[("水印项目", f"*{watermark_project.PROJECT_SUFFIX}")])
+        if path:
+            try:
+                self.project.save_as(path)
+            except Exception as e:
+                messagebox.showerror("错误", f"无法保存项目: {e}")
+                return
+            self.root.title(f"照片水印工具 - {os.path.basename(path)}")
+    
+    def confirm_discard_project(self):
+        """未保存的项目中有图片时确认是否放弃"""
+        if self.project.is_saved or not self.images:
+            return True
+        return messagebox.askyesno("确认", "当前项目尚未保存，确定要放弃吗？")
+    
+    def switch_project(self, project):
+        """关闭当前项目并显示新项目（恢复上次的当前图片和输出文件夹）"""
+        self.save_current_watermark_config()
+        # 停止正在进行的文件夹导入，扫描结果属于旧项目
+        for scanner in self.scanners:
+            scanner.cancel()
+        self.scanners = []
+        if self.import_after_id is not None:
+            self.root.after_cancel(self.import_after_id)
+            self.import_after_id = None
+        self.project.close()
+        self.set_project(project)
+        self.prefetcher.cancel()
+        self.current_image = None
+        self.current_image_size = None
+        self.current_image_index = min(int(project.get_meta('current_index', 0)), max(0, len(self.images) - 1))
+        self.output_folder = project.get_meta('output_folder')
+        if self.output_folder:
+            self.folder_label.config(text=os.path.basename(self.output_folder), foreground="black")
+        else:
+            self.folder_label.config(text="未选择", foreground="gray")
+        title = os.path.basename(project.path) if project.is_saved else None
+        self.root.title(f"照片水印工具 - {title}" if title else "照片水印工具")
+        self.update_image_list()
+        if self.images:
+            self.image_list.select(self.current_image_index)
+            self.load_current_image()
+        else:
+            self.preview_canvas.delete("all")
+            self.update_image_info()
+    
+    def commit_project(self):
+        """定期提交项目修改"""
+        try:
+            self.project.commit()
+        finally:
+            self.root.after(PROJECT_COMMIT_MS, self.commit_project)
+    
+    def on_close(self):
+        """关闭窗口时提交项目修改"""
+        self.save_current_watermark_config()
+        self.project.close()
+        self.root.destroy()
     
     def update_image_list(self):
         """更新图片列表显示"""
-        self.image_listbox.delete(0, tk.END)
-        for i, img_path in enumerate(self.images):
-            filename = os.path.basename(img_path)
-            self.image_listbox.insert(tk.END, f"{i+1}. {filename}")
+        self.image_list.set_count(len(self.images))
+        self.image_list.refresh()
     
-    def on_image_select(self, event):
+    def append_image_rows(self, start):
+        """追加新导入的图片行（只更新行数，可见行按需生成）"""
+        self.image_list.set_count(len(self.images))
+    
+    def image_row_text(self, index):
+        """生成列表中第index行的文本"""
+        return f"{index+1}. {os.path.basename(self.images[index])}"
+    
+    def on_image_select(self, index):
         """图片选择事件"""
-        selection = self.image_listbox.curselection()
-        if selection:
-            self.current_image_index = selection[0]
-            self.load_current_image()
+        self.current_image_index = index
+        self.load_current_image()
     
     def load_current_image(self):
         """加载当前选中的图片"""
@@ -313,7 +530,21 @@ class WorkingWatermarkApp:
         
         try:
             img_path = self.images[self.current_image_index]
-            self.current_image = Image.open(img_path)
+            
+            # 优先使用后台预读好的图片；只解码到预览需要的分辨率，完整分辨率在导出时解码
+            max_width, max_height = self.get_preview_size()
+            entry = self.prefetcher.get(img_path)
+            if entry is None:
+                entry = self.prefetcher.load(img_path, max_width, max_height)
+            self.current_image = entry.image
+            self.current_image_size = entry.full_size
+            self.preview_proxy = entry.proxy
+            self.preview_proxy_scale = entry.proxy_scale
+            self.preview_proxy_key = entry.preview_size
+            self.project.set_meta('current_index', self.current_image_index)
+            
+            # 预读前后相邻的图片
+            self.prefetcher.prefetch(self.images, self.current_image_index, max_width, max_height)
             
             # 加载当前图片的水印配置
             self.load_watermark_config_for_current_image()
@@ -327,18 +558,14 @@ class WorkingWatermarkApp:
         """保存当前图片的水印配置"""
         if self.images and 0 <= self.current_image_index < len(self.images):
             img_path = self.images[self.current_image_index]
-            self.image_watermark_configs[img_path] = self.watermark_config.copy()
+            self.image_watermark_configs.set(img_path, self.watermark_config)
     
     def load_watermark_config_for_current_image(self):
         """加载当前图片的水印配置"""
         if self.images and 0 <= self.current_image_index < len(self.images):
             img_path = self.images[self.current_image_index]
-            if img_path in self.image_watermark_configs:
-                # 加载该图片的独立配置
-                self.watermark_config = self.image_watermark_configs[img_path].copy()
-            else:
-                # 使用默认配置
-                self.watermark_config = self.default_watermark_config.copy()
+            # 加载该图片的独立配置（没有单独设置时为公共模板）
+            self.watermark_config = self.image_watermark_configs.get(img_path).copy()
             
             # 更新UI显示
             self.update_ui_from_config()
@@ -356,21 +583,12 @@ class WorkingWatermarkApp:
             self.root.after(100, self.display_image)
             return
         
-        # 缩放图片
-        img = self.current_image.copy()
-        scale_x = canvas_width / img.width
-        scale_y = canvas_height / img.height
-        scale = min(scale_x, scale_y, 1.0)
+        # 使用缓存的预览代理图，避免每次重绘都缩放原图
+        proxy, scale = self.get_preview_proxy(canvas_width, canvas_height)
+        new_width, new_height = proxy.size
         
-        new_width = int(img.width * scale)
-        new_height = int(img.height * scale)
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # 保存缩放信息，用于水印位置计算
-        self.display_scale = scale
-        
-        # 添加水印（使用缩放后的图片）
-        img = self.add_watermark_to_image(img)
+        # 添加水印（使用缩放后的图片，位置和字体按缩放比例换算）
+        img = self.add_watermark_to_image(proxy, scale=scale)
         
         # 转换为PhotoImage
         self.photo = ImageTk.PhotoImage(img)
@@ -380,95 +598,133 @@ class WorkingWatermarkApp:
         x = (canvas_width - new_width) // 2
         y = (canvas_height - new_height) // 2
         self.preview_canvas.create_image(x, y, anchor=tk.NW, image=self.photo)
+        self.preview_mode = 'full'
         
         # 保存缩放信息
         self.display_scale = scale
         self.display_offset_x = x
         self.display_offset_y = y
     
-    def add_watermark_to_image(self, img):
-        """在图片上添加水印"""
-        if not self.watermark_config['text']:
-            return img
-        
-        # 确保图片是RGBA模式
-        if img.mode != 'RGBA':
-            img = img.convert('RGBA')
-        
-        # 创建绘图对象
-        draw = ImageDraw.Draw(img)
-        
-        # 计算水印位置和字体大小
-        # 始终使用原始图片尺寸进行位置计算，确保预览和导出一致
-        pos_x, pos_y = self.watermark_config['position']
-        font_size = self.watermark_config['font_size']
-        
-        # 如果是预览模式，需要将位置和字体大小按比例缩放
-        if hasattr(self, 'display_scale'):
-            pos_x = int(pos_x * self.display_scale)
-            pos_y = int(pos_y * self.display_scale)
-            font_size = int(font_size * self.display_scale)
-            print(f"预览模式: 缩放后位置({pos_x}, {pos_y}), 字体大小{font_size}, 缩放比例{self.display_scale}")
+    def display_watermark_overlay(self):
+        """快速预览：底图为不含水印的代理图，水印作为单独的画布图层，拖拽时只移动图层"""
+        if not self.current_image:
+            return
+        
+        canvas_width = self.preview_canvas.winfo_width()
+        canvas_height = self.preview_canvas.winfo_height()
+        if canvas_width <= 1 or canvas_height <= 1 or self.watermark_config.get('tiled'):
+            # 平铺水印覆盖整张预览图，直接在代理图上完整绘制
+            self.display_image()
+            return
+        
+        proxy, scale = self.get_preview_proxy(canvas_width, canvas_height)
+        
+        # 底图只在进入快速预览或代理图变化时更新
+        if self.preview_mode != 'overlay' or self.proxy_photo_source is not proxy:
+            self.proxy_photo = ImageTk.PhotoImage(proxy)
+            self.proxy_photo_source = proxy
+            self.preview_canvas.delete("all")
+            x = (canvas_width - proxy.width) // 2
+            y = (canvas_height - proxy.height) // 2
+            self.preview_canvas.create_image(x, y, anchor=tk.NW, image=self.proxy_photo, tags="preview")
+            self.display_scale = scale
+            self.display_offset_x = x
+            self.display_offset_y = y
+            self.overlay_key = None
+            self.preview_mode = 'overlay'
+        
+        placement = watermark_engine.place_watermark(proxy.size, self.watermark_config, scale)
+        region = watermark_engine.stamp_region(proxy.size, *placement) if placement else None
+        if region is None:
+            self.preview_canvas.delete("overlay")
+            self.overlay_key = None
+            return
+        
+        stamp = placement[0]
+        box, source = region
+        overlay_x = self.display_offset_x + box[0]
+        overlay_y = self.display_offset_y + box[1]
+        
+        if self.overlay_key and self.overlay_key[0] is stamp and self.overlay_key[1] == source:
+            # 水印图块未变化（如拖拽），只移动画布图层
+            self.preview_canvas.coords("overlay", overlay_x, overlay_y)
+        else:
+            sprite = stamp.image
+            if source != (0, 0, sprite.width, sprite.height):
+                sprite = sprite.crop(source)
+            self.overlay_photo = ImageTk.PhotoImage(sprite)
+            self.preview_canvas.delete("overlay")
+            self.preview_canvas.create_image(overlay_x, overlay_y, anchor=tk.NW,
+                                             image=self.overlay_photo, tags="overlay")
+            self.overlay_key = (stamp, source)
+    
+    def request_redraw(self, interactive=False):
+        """请求重绘预览
+        
+        同一帧内的多次请求只执行一次，并使用执行时最新的水印配置；交互中（拖拽、滑块）
+        使用快速预览，停止交互一段时间后自动进行一次高质量重绘。
+        """
+        if not self.current_image:
+            return
+        
+        if interactive:
+            if self.idle_after_id is not None:
+                self.root.after_cancel(self.idle_after_id)
+            self.idle_after_id = self.root.after(PREVIEW_IDLE_MS, self.on_interaction_idle)
         else:
-            print(f"导出模式: 原始位置({pos_x}, {pos_y}), 字体大小{font_size}")
+            self.full_redraw_pending = True
         
-        # 计算字体（支持中文）
-        try:
-            # 优先尝试中文字体
-            font = ImageFont.truetype("/System/Library/Fonts/PingFang.ttc", font_size)
-        except:
-            try:
-                font = ImageFont.truetype("/System/Library/Fonts/STHeiti Light.ttc", font_size)
-            except:
-                try:
-                    font = ImageFont.truetype("/System/Library/Fonts/Arial Unicode MS.ttf", font_size)
-                except:
-                    try:
-                        font = ImageFont.truetype("arial.ttf", font_size)
-                    except:
-                        try:
-                            font = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", font_size)
-                        except:
-                            font = ImageFont.load_default()
-        
-        # 计算透明度
-        alpha = int(255 * self.watermark_config['opacity'] / 100)
-        color = (*self.watermark_config['font_color'], alpha)
-        
-        # 绘制水印
-        if self.watermark_config['rotation'] != 0:
-            # 先获取文字边界框
-            bbox = draw.textbbox((0, 0), self.watermark_config['text'], font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-            
-            # 创建只包含文字的临时图片
-            temp_img = Image.new('RGBA', (text_width + 20, text_height + 20), (0, 0, 0, 0))
-            temp_draw = ImageDraw.Draw(temp_img)
-            temp_draw.text((10, 10), self.watermark_config['text'], font=font, fill=color)
-            
-            # 围绕文字中心旋转
-            rotated = temp_img.rotate(self.watermark_config['rotation'], expand=True)
-            
-            # 计算在原图中的粘贴位置（考虑旋转后的偏移）
-            paste_x = pos_x - (rotated.width - text_width) // 2
-            paste_y = pos_y - (rotated.height - text_height) // 2
-            
-            # 确保粘贴位置在图片范围内
-            paste_x = max(0, min(paste_x, img.width - rotated.width))
-            paste_y = max(0, min(paste_y, img.height - rotated.height))
-            
-            # 创建与原图相同尺寸的透明图片
-            final_watermark = Image.new('RGBA', img.size, (0, 0, 0, 0))
-            final_watermark.paste(rotated, (paste_x, paste_y), rotated)
-            
-            # 合并到原图
-            img = Image.alpha_composite(img, final_watermark)
+        if self.redraw_after_id is None:
+            self.redraw_after_id = self.root.after(PREVIEW_FRAME_MS, self.flush_redraw)
+    
+    def flush_redraw(self):
+        """执行合并后的重绘"""
+        self.redraw_after_id = None
+        if self.full_redraw_pending:
+            self.full_redraw_pending = False
+            with watermark_trace.span("preview.full"):
+                self.display_image()
         else:
-            draw.text((pos_x, pos_y), self.watermark_config['text'], font=font, fill=color)
+            with watermark_trace.span("preview.overlay"):
+                self.display_watermark_overlay()
+    
+    def on_interaction_idle(self):
+        """交互停止后进行高质量重绘"""
+        self.idle_after_id = None
+        self.request_redraw()
+    
+    def get_preview_size(self):
+        """返回预览区域尺寸，画布尚未显示时使用屏幕尺寸"""
+        canvas_width = self.preview_canvas.winfo_width()
+        canvas_height = self.preview_canvas.winfo_height()
+        if canvas_width <= 1 or canvas_height <= 1:
+            return self.root.winfo_screenwidth(), self.root.winfo_screenheight()
+        return canvas_width, canvas_height
+    
+    def get_preview_proxy(self, canvas_width, canvas_height):
+        """获取当前图片的预览代理图，仅在图片或画布尺寸变化时重新缩放"""
+        key = (canvas_width, canvas_height)
+        if self.preview_proxy is None or self.preview_proxy_key != key:
+            # 画布变大后，按缩小分辨率解码的图片不够清晰时重新解码
+            full_width, full_height = self.current_image_size
+            scale = min(canvas_width / full_width, canvas_height / full_height, 1.0)
+            if (self.current_image.width < int(full_width * scale)
+                    or self.current_image.height < int(full_height * scale)):
+                self.current_image, _ = watermark_engine.open_for_preview(
+                    self.images[self.current_image_index], canvas_width, canvas_height)
+            
+            self.preview_proxy, self.preview_proxy_scale = watermark_engine.make_preview(
+                self.current_image, canvas_width, canvas_height, self.current_image_size)
+            self.preview_proxy_key = key
+        return self.preview_proxy, self.preview_proxy_scale
+    
+    def add_watermark_to_image(self, img, config=None, scale=1.0):
+        """在图片上添加水印（config默认为当前显示的水印配置）"""
+        if config is None:
+            config = self.watermark_config
         
-        # 转换回原始模式
-        return img
+        with watermark_trace.span("preview.render", scale=scale, size=list(img.size)):
+            return watermark_engine.render_watermark(img, config, scale)
     
     def update_watermark(self, *args):
         """更新水印设置"""
@@ -476,6 +732,8 @@ class WorkingWatermarkApp:
         self.watermark_config['font_size'] = self.font_size_var.get()
         self.watermark_config['opacity'] = self.opacity_var.get()
         self.watermark_config['rotation'] = self.rotation_var.get()
+        self.watermark_config['tiled'] = self.tiled_var.get()
+        self.watermark_config['tile_spacing'] = self.tile_spacing_var.get()
         
         # 更新字体大小显示
         if hasattr(self, 'font_size_label'):
@@ -484,9 +742,8 @@ class WorkingWatermarkApp:
         # 保存当前图片的水印配置
         self.save_current_watermark_config()
         
-        if self.current_image:
-            # 直接更新，提高响应速度
-            self.display_image()
+        # 合并连续的滑块事件，交互中只更新水印图层
+        self.request_redraw(interactive=True)
     
     def choose_color(self):
         """选择颜色"""
@@ -510,26 +767,10 @@ class WorkingWatermarkApp:
             return
         
         # 计算实际位置（使用原始图片尺寸）
-        img_width = self.current_image.width
-        img_height = self.current_image.height
+        img_width, img_height = self.current_image_size
         
         # 获取水印文字的大致尺寸（支持中文）
-        try:
-            font = ImageFont.truetype("/System/Library/Fonts/PingFang.ttc", self.watermark_config['font_size'])
-        except:
-            try:
-                font = ImageFont.truetype("/System/Library/Fonts/STHeiti Light.ttc", self.watermark_config['font_size'])
-            except:
-                try:
-                    font = ImageFont.truetype("/System/Library/Fonts/Arial Unicode MS.ttf", self.watermark_config['font_size'])
-                except:
-                    try:
-                        font = ImageFont.truetype("arial.ttf", self.watermark_config['font_size'])
-                    except:
-                        try:
-                            font = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", self.watermark_config['font_size'])
-                        except:
-                            font = ImageFont.load_default()
+        font = watermark_engine.load_font(self.watermark_config['font_size'])
         
         # 估算文字尺寸
         bbox = font.getbbox(self.watermark_config['text'])
@@ -549,8 +790,9 @@ class WorkingWatermarkApp:
         pos_x = max(10, min(pos_x, img_width - text_width - 10))
         pos_y = max(10, min(pos_y, img_height - text_height - 10))
         
-        # 调试信息（可以在控制台看到）
-        print(f"位置计算: 坐标{position} -> 像素位置({pos_x}, {pos_y}), 图片尺寸({img_width}x{img_height}), 文字尺寸({text_width}x{text_height})")
+        # 调试信息（启用性能追踪时记录）
+        watermark_trace.event("set_position", ratio=list(position), position=[pos_x, pos_y],
+                              image_size=[img_width, img_height], text_size=[text_width, text_height])
         
         self.watermark_config['position'] = (pos_x, pos_y)
         
@@ -559,6 +801,10 @@ class WorkingWatermarkApp:
         
         self.display_image()
     
+    def on_canvas_resize(self, event):
+        """预览画布尺寸变化事件"""
+        self.request_redraw()
+    
     def on_canvas_click(self, event):
         """画布点击事件"""
         if not self.current_image or not self.watermark_config['text']:
@@ -569,7 +815,7 @@ class WorkingWatermarkApp:
         self.dragging = True
         self.drag_start_pos = (event.x, event.y)
         self.preview_canvas.config(cursor="hand2")
-        print(f"开始拖拽: 点击位置({event.x}, {event.y})")
+        watermark_trace.event("drag.start", x=event.x, y=event.y)
     
     def on_canvas_drag(self, event):
         """画布拖拽事件"""
@@ -582,8 +828,7 @@ class WorkingWatermarkApp:
             new_y = (event.y - self.display_offset_y) / self.display_scale
             
             # 确保位置在图片范围内
-            img_width = self.current_image.width
-            img_height = self.current_image.height
+            img_width, img_height = self.current_image_size
             new_x = max(0, min(new_x, img_width))
             new_y = max(0, min(new_y, img_height))
             
@@ -593,9 +838,9 @@ class WorkingWatermarkApp:
             # 保存当前图片的水印配置
             self.save_current_watermark_config()
             
-            # 直接更新显示，提高响应速度
-            self.display_image()
-            print(f"拖拽中: 新位置({int(new_x)}, {int(new_y)})")
+            # 合并连续的拖拽事件，拖拽中只移动水印图层
+            self.request_redraw(interactive=True)
+            watermark_trace.count("drag.events")
     
     def on_canvas_release(self, event):
         """画布释放事件"""
@@ -603,21 +848,20 @@ class WorkingWatermarkApp:
             self.dragging = False
             self.drag_start_pos = None
             self.preview_canvas.config(cursor="")
+            self.request_redraw()
     
     def prev_image(self):
         """上一张图片"""
         if self.images and self.current_image_index > 0:
             self.current_image_index -= 1
-            self.image_listbox.selection_clear(0, tk.END)
-            self.image_listbox.selection_set(self.current_image_index)
+            self.image_list.select(self.current_image_index)
             self.load_current_image()
     
     def next_image(self):
         """下一张图片"""
         if self.images and self.current_image_index < len(self.images) - 1:
             self.current_image_index += 1
-            self.image_listbox.selection_clear(0, tk.END)
-            self.image_listbox.selection_set(self.current_image_index)
+            self.image_list.select(self.current_image_index)
             self.load_current_image()
     
     def update_image_info(self):
@@ -625,8 +869,15 @@ class WorkingWatermarkApp:
         if self.images:
             current = self.current_image_index + 1
             total = len(self.images)
-            filename = os.path.basename(self.images[self.current_image_index])
-            self.image_info_label.config(text=f"{current}/{total} - {filename}")
+            img_path = self.images[self.current_image_index]
+            filename = os.path.basename(img_path)
+            if self.current_image_size:
+                width, height = self.current_image_size
+                info = self.images.info(self.current_image_index)
+                image_format = f" {info.format}" if info else ""
+                self.image_info_label.config(text=f"{current}/{total} - {filename} ({width}x{height}{image_format})")
+            else:
+                self.image_info_label.config(text=f"{current}/{total} - {filename}")
         else:
             self.image_info_label.config(text="请导入图片")
     
@@ -635,10 +886,15 @@ class WorkingWatermarkApp:
         folder = filedialog.askdirectory(title="选择输出文件夹")
         if folder:
             self.output_folder = folder
+            self.project.set_meta('output_folder', folder)
             self.folder_label.config(text=os.path.basename(folder), foreground="black")
     
     def export_all(self):
-        """导出所有图片"""
+        """导出所有图片（后台进行，导出期间界面可以继续使用）"""
+        if self.export_job and self.export_job.is_running():
+            messagebox.showwarning("警告", "正在导出，请等待完成或取消")
+            return
+        
         if not self.images:
             messagebox.showwarning("警告", "请先导入图片")
             return
@@ -647,60 +903,95 @@ class WorkingWatermarkApp:
             messagebox.showwarning("警告", "请选择输出文件夹")
             return
         
+        # 上次导出到该文件夹时被中断：继续（跳过已完成的图片）或全部重新导出
+        force = False
+        if watermark_manifest.interrupted_run(self.output_folder) is not None:
+            answer = messagebox.askyesnocancel("继续导出", "该文件夹中有未完成的导出。\n"
+                                               "是：继续导出，跳过已完成的图片\n否：全部重新导出")
+            if answer is None:
+                return
+            force = not answer
+        
+        # 使用每张图片的独立水印配置（只读配置，之后的修改不影响本次导出）
+        self.image_watermark_configs.preload()
+        items = [(img_path, self.image_watermark_configs.get(img_path)) for img_path in self.images]
+        self.export_errors = []
+        self.export_job = watermark_export.ExportJob(items, self.output_folder, settings=self.get_export_settings(),
+                                                     force=force).start()
+        
+        self.export_button.config(state=tk.DISABLED)
+        self.cancel_export_button.config(state=tk.NORMAL)
+        self.export_progress.config(value=0, maximum=max(1, len(items)))
+        self.export_status_label.config(text="正在检查需要导出的图片...")
+        self.root.after(EXPORT_POLL_MS, self.poll_export)
+    
+    def on_encoder_preset_select(self, event=None):
+        """选择编码预设时把质量滑块设为预设的质量"""
+        preset = ENCODER_PRESET_CHOICES[self.encoder_preset_var.get()]
+        quality = watermark_engine.export_settings(preset)['quality']
+        self.export_quality_var.set(quality)
+        self.export_quality_label.config(text=f"质量: {quality}")
+    
+    def get_export_settings(self):
+        """根据导出面板的选择生成导出设置"""
+        return watermark_engine.export_settings(
+            ENCODER_PRESET_CHOICES[self.encoder_preset_var.get()],
+            format=OUTPUT_FORMAT_CHOICES[self.output_format_var.get()],
+            quality=self.export_quality_var.get())
+    
+    def cancel_export(self):
+        """取消导出（当前正在处理的图片完成后停止）"""
+        if self.export_job and self.export_job.is_running():
+            self.export_job.cancel()
+            self.cancel_export_button.config(state=tk.DISABLED)
+            self.export_status_label.config(text="正在取消，等待当前图片完成...")
+    
+    def poll_export(self):
+        """读取后台导出的进度事件并更新界面"""
+        job = self.export_job
+        finished = None
         try:
-            total = len(self.images)
-            for i, img_path in enumerate(self.images):
-                # 更新进度
-                self.image_info_label.config(text=f"导出中: {i+1}/{total}")
-                self.root.update()
-                
-                # 加载原图
-                original_img = Image.open(img_path)
-                
-                # 清除预览缩放属性，确保导出使用原始尺寸
-                if hasattr(self, 'display_scale'):
-                    delattr(self, 'display_scale')
-                
-                # 使用该图片的独立水印配置
-                if img_path in self.image_watermark_configs:
-                    img_watermark_config = self.image_watermark_configs[img_path]
-                else:
-                    img_watermark_config = self.default_watermark_config
-                
-                # 临时保存当前配置，使用图片的独立配置
-                temp_config = self.watermark_config.copy()
-                self.watermark_config = img_watermark_config.copy()
-                
-                # 添加水印
-                print(f"导出图片: {os.path.basename(img_path)}")
-                print(f"导出时水印位置: {self.watermark_config['position']}")
-                print(f"导出时图片尺寸: {original_img.size}")
-                watermarked_img = self.add_watermark_to_image(original_img)
-                
-                # 恢复当前配置
-                self.watermark_config = temp_config
-                
-                # 生成输出文件名
-                filename = os.path.basename(img_path)
-                name, ext = os.path.splitext(filename)
-                new_filename = f"{name}_watermarked{ext}"
-                
-                # 保存图片
-                output_path = os.path.join(self.output_folder, new_filename)
-                # 确保保存时使用正确的模式
-                if watermarked_img.mode == 'RGBA':
-                    # 如果是RGBA模式，转换为RGB保存
-                    rgb_img = Image.new('RGB', watermarked_img.size, (255, 255, 255))
-                    rgb_img.paste(watermarked_img, mask=watermarked_img.split()[-1])
-                    rgb_img.save(output_path, quality=95)
-                else:
-                    watermarked_img.save(output_path, quality=95)
-            
-            messagebox.showinfo("成功", f"已导出 {total} 张图片到 {self.output_folder}")
-            self.image_info_label.config(text=f"导出完成: {total} 张图片")
-            
-        except Exception as e:
-            messagebox.showerror("错误", f"导出失败: {e}")
+            while True:
+                event = job.events.get_nowait()
+                if event['type'] == 'progress':
+                    self.show_export_progress(event)
+                elif event['type'] == 'error':
+                    self.export_errors.append(event)
+                    watermark_trace.event("export.error", path=event['path'], error=event['error'])
+                elif event['type'] == 'finished':
+                    finished = event
+        except queue.Empty:
+            pass
+        
+        if finished is None:
+            self.root.after(EXPORT_POLL_MS, self.poll_export)
+            return
+        
+        self.export_button.config(state=tk.NORMAL)
+        self.cancel_export_button.config(state=tk.DISABLED)
+        summary = f"已导出 {finished['done']} 张，跳过 {finished['skipped']} 张未变化的图片"
+        if finished['failed']:
+            summary += f"，失败 {finished['failed']} 张"
+        self.export_status_label.config(text=f"{summary}（用时 {finished['elapsed']:.1f} 秒）")
+        
+        if finished['cancelled']:
+            messagebox.showinfo("已取消", f"导出已取消：{summary}")
+        elif self.export_errors:
+            first_error = self.export_errors[0]
+            messagebox.showerror("错误", f"{summary}\n导出失败: {first_error['path'] or ''} {first_error['error']}")
+        else:
+            messagebox.showinfo("成功", f"{summary}，输出到 {self.output_folder}")
+    
+    def show_export_progress(self, event):
+        """显示导出进度、速度和预计剩余时间"""
+        processed = event['done'] + event['failed']
+        self.export_progress.config(maximum=max(1, event['total']), value=processed)
+        text = f"导出中: {processed}/{event['total']}"
+        if event['rate'] > 0:
+            text += f"，{event['rate']:.1f} 张/秒"
+        if event['eta'] is not None:
+            text += f"，剩余约 {int(event['eta'])} 秒"
+        self.export_status_label.config(text=text)
     
     # 模板系统方法
     def load_templates(self):
@@ -745,8 +1036,8 @@ class WorkingWatermarkApp:
         
         template_name = self.template_listbox.get(selection[0])
         if template_name in self.templates:
-            # 应用模板设置到当前图片
-            self.watermark_config.update(self.templates[template_name])
+            # 应用模板设置到当前图片（旧模板缺少的字段如平铺使用默认值，不沿用之前的设置）
+            self.watermark_config = watermark_engine.config_from_template(self.templates[template_name])
             self.update_ui_from_config()
             
             # 保存当前图片的水印配置
@@ -778,13 +1069,12 @@ class WorkingWatermarkApp:
         if not result:
             return
         
-        # 批量应用模板到每张图片的独立配置
-        template_config = self.templates[template_name]
-        for img_path in self.images:
-            self.image_watermark_configs[img_path] = template_config.copy()
+        # 批量应用模板：替换公共模板，所有图片的独立设置失效（与图片数量无关）
+        template_config = watermark_engine.config_from_template(self.templates[template_name])
+        self.image_watermark_configs.apply_to_all(template_config)
         
         # 应用模板到当前显示
-        self.watermark_config.update(template_config)
+        self.watermark_config = template_config.copy()
         self.update_ui_from_config()
         self.display_image()
         
@@ -833,6 +1123,8 @@ class WorkingWatermarkApp:
         self.font_size_var.set(self.watermark_config['font_size'])
         self.opacity_var.set(self.watermark_config['opacity'])
         self.rotation_var.set(self.watermark_config['rotation'])
+        self.tiled_var.set(self.watermark_config.get('tiled', False))
+        self.tile_spacing_var.set(self.watermark_config.get('tile_spacing', self.default_watermark_config['tile_spacing']))
         
         # 更新颜色显示
         self.color_label.config(fg=self.rgb_to_hex(self.watermark_config['font_color']))
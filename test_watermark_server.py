@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+水印服务测试 - 客户端输入错误（X-Watermark-Config、无法解码的图片）返回400，不会在工作进程中失败成为500
+
+运行：python -m pytest -q test_watermark_server.py（或 python -m unittest test_watermark_server）
+"""
+
+import io
+import json
+import asyncio
+import unittest
+
+from PIL import Image
+
+import watermark_engine
+import watermark_server
+
+
+def _jpeg_bytes():
+    buffer = io.BytesIO()
+    Image.new('RGB', (120, 80), 'white').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+async def _post(port, body, config):
+    """发送一个POST /watermark请求，返回(状态码, 响应体)"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    header = json.dumps(config, ensure_ascii=False).encode('utf-8')
+    writer.write(b"POST /watermark HTTP/1.1\r\nHost: test\r\nConnection: close\r\n"
+                 b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                 b"X-Watermark-Config: " + header + b"\r\n\r\n" + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, data = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), data
+
+
+class InlineConfigTest(unittest.TestCase):
+    """通过HTTP发送内联配置，检查各种错误都返回400"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.body = _jpeg_bytes()
+
+    def request(self, config):
+        async def run():
+            server = watermark_server.WatermarkServer({}, workers=1, threads=True)
+            server._slots = asyncio.Semaphore(server.concurrency)
+            server.start_executor()
+            listener = await asyncio.start_server(server._handle_connection, '127.0.0.1', 0)
+            try:
+                port = listener.sockets[0].getsockname()[1]
+                return await _post(port, self.body, config)
+            finally:
+                listener.close()
+                await listener.wait_closed()
+                server.executor.shutdown(wait=True)
+        return asyncio.run(run())
+
+    def assertRejected(self, config, field):
+        status, data = self.request(config)
+        self.assertEqual(status, 400, data)
+        self.assertIn(field, json.loads(data)['error'])
+
+    def test_valid_config(self):
+        status, data = self.request({'text': '测试', 'font_size': 20, 'opacity': 50, 'font_color': [0, 0, 255],
+                                     'position': [10, 10], 'rotation': 30, 'tiled': True, 'tile_spacing': 40})
+        self.assertEqual(status, 200)
+        self.assertTrue(data.startswith(b'\xff\xd8'))
+
+    def test_corrupt_image(self):
+        # 文件头是JPEG但内容无法解码：400，信息中不含BytesIO对象的repr
+        self.body = b'\xff\xd8\xff' + b'garbage' * 10
+        status, data = self.request({'text': '测试'})
+        self.assertEqual(status, 400)
+        self.assertNotIn('BytesIO', json.loads(data)['error'])
+
+    def test_not_an_object(self):
+        status, _ = self.request([1, 2])
+        self.assertEqual(status, 400)
+
+    def test_unknown_key(self):
+        self.assertRejected({'font': 'Arial'}, 'font')
+
+    def test_text(self):
+        self.assertRejected({'text': 5}, 'text')
+
+    def test_font_size(self):
+        self.assertRejected({'font_size': 'big'}, 'font_size')
+        self.assertRejected({'font_size': 0}, 'font_size')
+        self.assertRejected({'font_size': 12.5}, 'font_size')
+
+    def test_opacity(self):
+        self.assertRejected({'opacity': 500}, 'opacity')
+        self.assertRejected({'opacity': -1}, 'opacity')
+        self.assertRejected({'opacity': '50'}, 'opacity')
+
+    def test_rotation(self):
+        self.assertRejected({'rotation': 'left'}, 'rotation')
+        self.assertRejected({'rotation': 720}, 'rotation')
+
+    def test_position(self):
+        self.assertRejected({'position': [10]}, 'position')
+        self.assertRejected({'position': ['a', 'b']}, 'position')
+        self.assertRejected({'position': [-5, 10]}, 'position')
+
+    def test_font_color(self):
+        self.assertRejected({'font_color': [255, 0]}, 'font_color')
+        self.assertRejected({'font_color': [256, 0, 0]}, 'font_color')
+        self.assertRejected({'font_color': '#ff0000'}, 'font_color')
+
+    def test_tiled(self):
+        self.assertRejected({'tiled': 'yes'}, 'tiled')
+        self.assertRejected({'tiled': 1}, 'tiled')
+
+    def test_tile_spacing(self):
+        self.assertRejected({'tile_spacing': -10}, 'tile_spacing')
+        self.assertRejected({'tile_spacing': True}, 'tile_spacing')
+
+
+class ConfigChecksTest(unittest.TestCase):
+
+    def test_checks_cover_default_config(self):
+        # 新增配置字段时需要同时加入检查
+        self.assertEqual(watermark_server._CONFIG_CHECKS.keys(), watermark_engine.DEFAULT_WATERMARK_CONFIG.keys())
+
+    def test_default_config_passes(self):
+        config = {key: list(value) if isinstance(value, tuple) else value
+                  for key, value in watermark_engine.DEFAULT_WATERMARK_CONFIG.items()}
+        watermark_server.check_config_overrides(config)
+
+
+if __name__ == "__main__":
+    unittest.main()
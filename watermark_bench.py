@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能基准测试 - 生成确定性的合成图片集，测量渲染、预览和批量导出的吞吐量和内存峰值
+
+用法：
+    python watermark_bench.py --sizes 1,12,50,100 --jobs 1,2,4 -o bench.json
+
+每个测试用例在单独的子进程中运行，内存峰值互不影响。结果以JSON输出，便于比较不同版本。
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import PIL
+from PIL import Image, ImageDraw, ImageFont
+
+import watermark_cli
+import watermark_engine
+import watermark_fonts
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 默认测试的图片尺寸（百万像素）、格式和旋转角度
+DEFAULT_SIZES = (1, 12, 50, 100)
+DEFAULT_FORMATS = ('.jpg', '.png', '.tiff')
+DEFAULT_ROTATIONS = (0, 30)
+DEFAULT_JOBS = (1, 2, 4)
+
+# 预览测试使用的画布尺寸
+PREVIEW_CANVAS = (1200, 800)
+
+# 不支持透明通道的格式
+OPAQUE_FORMATS = ('.jpg', '.jpeg', '.bmp')
+
+# 纹理图块尺寸：合成图片由曼德博集合图块平铺而成，保证编码器面对的是有细节的内容
+TILE_SIZE = 1024
+
+
+def _synthetic_image(width, height, alpha):
+    """生成确定性的合成图片：亮度为平铺的分形纹理，色彩和透明度为拉伸的渐变"""
+    tile = Image.effect_mandelbrot((TILE_SIZE, TILE_SIZE), (-2.0, -1.25, 0.5, 1.25), 64)
+    detail = Image.new('L', (width, height))
+    for y in range(0, height, TILE_SIZE):
+        for x in range(0, width, TILE_SIZE):
+            detail.paste(tile, (x, y))
+    bands = [
+        detail,
+        Image.linear_gradient('L').resize((width, height), Image.Resampling.BILINEAR),
+        Image.radial_gradient('L').resize((width, height), Image.Resampling.BILINEAR),
+    ]
+    if alpha:
+        bands.append(bands[2].point(lambda v: 255 - v // 2))
+        return Image.merge('RGBA', bands)
+    return Image.merge('RGB', bands)
+
+
+def corpus_name(megapixels, ext, alpha):
+    """合成图片的文件名"""
+    return f"synthetic_{megapixels}mp_{'rgba' if alpha else 'rgb'}{ext}"
+
+
+def make_corpus(folder, sizes=DEFAULT_SIZES, formats=DEFAULT_FORMATS):
+    """在folder中生成合成图片集（已存在的文件直接复用），返回图片路径列表
+
+    每种尺寸和格式各生成不透明和带透明通道两张（JPEG只有不透明），宽高比为3:2。
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for megapixels in sizes:
+        width = int((megapixels * 1_000_000 * 1.5) ** 0.5)
+        height = int(megapixels * 1_000_000 / width)
+        for ext in formats:
+            for alpha in (False, True):
+                if alpha and ext in OPAQUE_FORMATS:
+                    continue
+                path = os.path.join(folder, corpus_name(megapixels, ext, alpha))
+                if not os.path.exists(path):
+                    img = _synthetic_image(width, height, alpha)
+                    tmp_path = path + ".tmp"
+                    img.save(tmp_path, format=Image.registered_extensions()[ext], quality=90)
+                    os.replace(tmp_path, path)
+                paths.append(path)
+    return paths
+
+
+def bench_config(image_size, rotation, tiled=False):
+    """测试用水印配置：字号与图片宽度成比例，位于图片中央（平铺时字号较小）"""
+    config = dict(watermark_engine.DEFAULT_WATERMARK_CONFIG)
+    config['text'] = "© Photo Watermark 基准测试"
+    config['font_size'] = max(24, image_size[0] // 20)
+    config['position'] = (image_size[0] // 3, image_size[1] // 2)
+    config['rotation'] = rotation
+    if tiled:
+        config['tiled'] = True
+        config['font_size'] = max(24, image_size[0] // 60)
+        config['tile_spacing'] = config['font_size'] * 2
+    return config
+
+
+def _legacy_load_font(font_size):
+    """旧版的字体加载：每次都按顺序尝试候选字体，不缓存"""
+    for font_path in watermark_fonts.FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(font_path, font_size)
+        except Exception:
+            continue
+    return ImageFont.load_default()
+
+
+def legacy_render_watermark(img, config):
+    """旧版渲染方式（用于对比），与最初的add_watermark_to_image和导出保存步骤相同：
+
+    整图转换为RGBA，每张图片重新加载字体并绘制文字；旋转时创建与原图同样大小的透明图层
+    粘贴旋转后的文字再整图合成；最后合成到白色背景上转回RGB。只去掉了调试输出。
+    """
+    if not config['text']:
+        return img
+
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+    draw = ImageDraw.Draw(img)
+    pos_x, pos_y = config['position']
+    font_size = config['font_size']
+    font = _legacy_load_font(font_size)
+    alpha = int(255 * config['opacity'] / 100)
+    color = (*config['font_color'], alpha)
+
+    if config['rotation'] != 0:
+        bbox = draw.textbbox((0, 0), config['text'], font=font)
+        text_width = bbox[2] - bbox[0]
+        text_height = bbox[3] - bbox[1]
+
+        temp_img = Image.new('RGBA', (text_width + 20, text_height + 20), (0, 0, 0, 0))
+        temp_draw = ImageDraw.Draw(temp_img)
+        temp_draw.text((10, 10), config['text'], font=font, fill=color)
+        rotated = temp_img.rotate(config['rotation'], expand=True)
+
+        paste_x = pos_x - (rotated.width - text_width) // 2
+        paste_y = pos_y - (rotated.height - text_height) // 2
+        paste_x = max(0, min(paste_x, img.width - rotated.width))
+        paste_y = max(0, min(paste_y, img.height - rotated.height))
+
+        final_watermark = Image.new('RGBA', img.size, (0, 0, 0, 0))
+        final_watermark.paste(rotated, (paste_x, paste_y), rotated)
+        img = Image.alpha_composite(img, final_watermark)
+    else:
+        draw.text((pos_x, pos_y), config['text'], font=font, fill=color)
+
+    rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+    rgb_img.paste(img, mask=img.split()[-1])
+    return rgb_img
+
+
+def _peak_rss_mb():
+    """当前进程及其已结束子进程的内存峰值（MB），不支持的平台返回None"""
+    if resource is None:
+        return None
+    # Linux以KB为单位，macOS以字节为单位
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+    return round(max(own, children), 1)
+
+
+def _timings(fn, repeat):
+    """运行fn repeat次，返回每次的耗时（秒）"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _result(bench, case, timings, images, nbytes):
+    """汇总一个测试用例：中位耗时、吞吐量（张/秒、MB/秒）和内存峰值"""
+    seconds = statistics.median(timings)
+    return {
+        'bench': bench,
+        'case': case,
+        'repeat': len(timings),
+        'seconds': round(seconds, 6),
+        'min_seconds': round(min(timings), 6),
+        'images_per_sec': round(images / seconds, 3) if seconds > 0 else None,
+        'mb_per_sec': round(nbytes / seconds / 1e6, 3) if seconds > 0 else None,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def _image_case(path, img):
+    """描述测试图片的字段"""
+    return {
+        'image': os.path.basename(path),
+        'format': img.format,
+        'mode': img.mode,
+        'width': img.width,
+        'height': img.height,
+        'megapixels': round(img.width * img.height / 1e6, 2),
+    }
+
+
+def _decoded_bytes(img):
+    """解码后的像素数据大小"""
+    return img.width * img.height * len(img.getbands())
+
+
+def run_render(path, rotation, repeat, tiled=False):
+    """添加水印（与预览和导出中add_watermark_to_image的调用相同，不修改原图）"""
+    with Image.open(path) as img:
+        img.load()
+        case = _image_case(path, img)
+        case['rotation'] = rotation
+        config = bench_config(img.size, rotation, tiled)
+        watermark_engine.render_watermark(img, config)  # 预热字体和图块缓存
+        timings = _timings(lambda: watermark_engine.render_watermark(img, config), repeat)
+        return _result('tiled' if tiled else 'render', case, timings, 1, _decoded_bytes(img))
+
+
+def run_export_prepare(path, rotation, variant, repeat):
+    """解码原图并生成待编码的图片，对比当前的原模式合成（native）和旧版的RGBA往返（legacy）"""
+    ext = os.path.splitext(path)[1]
+    with Image.open(path) as img:
+        case = _image_case(path, img)
+        nbytes = _decoded_bytes(img)
+        config = bench_config(img.size, rotation)
+    case.update(rotation=rotation, variant=variant)
+
+    def native():
+        with Image.open(path) as img:
+            rendered = watermark_engine.render_watermark(img, config, in_place=True)
+            watermark_engine.convert_for_format(rendered, ext)
+
+    def legacy():
+        with Image.open(path) as img:
+            legacy_render_watermark(img, config)
+
+    fn = native if variant == 'native' else legacy
+    fn()  # 预热
+    return _result('export_prepare', case, _timings(fn, repeat), 1, nbytes)
+
+
+def run_encode(path, output_format, preset, repeat):
+    """编码预设：添加水印后的图片按指定格式和预设编码的耗时和输出大小"""
+    settings = watermark_engine.export_settings(preset, format=output_format)
+    ext = watermark_engine.OUTPUT_FORMATS[output_format]
+    with Image.open(path) as img:
+        img.load()
+        case = _image_case(path, img)
+        case.update(output_format=output_format, preset=preset or 'default')
+        rendered = watermark_engine.render_watermark(img, bench_config(img.size, 0))
+        nbytes = _decoded_bytes(rendered)
+
+    def encode():
+        output = io.BytesIO()
+        watermark_engine.save_image(rendered, output, settings, ext=ext)
+        return output.tell()
+
+    case['output_bytes'] = encode()
+    return _result('encode', case, _timings(encode, repeat), 1, nbytes)
+
+
+def run_preview(path, repeat):
+    """预览：首次显示（解码、生成代理图、添加水印）和重绘（只在代理图上添加水印）"""
+    canvas_width, canvas_height = PREVIEW_CANVAS
+    with Image.open(path) as img:
+        case = _image_case(path, img)
+        nbytes = _decoded_bytes(img)
+        config = bench_config(img.size, DEFAULT_ROTATIONS[-1])
+    state = {}
+
+    def first_display():
+        img, full_size = watermark_engine.open_for_preview(path, canvas_width, canvas_height)
+        proxy, scale = watermark_engine.make_preview(img, canvas_width, canvas_height, full_size)
+        watermark_engine.render_watermark(proxy, config, scale)
+        state['proxy'], state['scale'] = proxy, scale
+
+    def redraw():
+        watermark_engine.render_watermark(state['proxy'], config, state['scale'])
+
+    first_display()
+    results = [_result('preview', dict(case, stage='open'), _timings(first_display, repeat), 1, nbytes)]
+    proxy = state['proxy']
+    results.append(_result('preview', dict(case, stage='redraw', preview_size=list(proxy.size)),
+                           _timings(redraw, repeat * 10), 1, _decoded_bytes(proxy)))
+    return results
+
+
+def run_export(paths, jobs, repeat):
+    """批量导出（命令行工具的导出路径），吞吐量按原图文件大小计算"""
+    nbytes = sum(os.path.getsize(path) for path in paths)
+    with Image.open(paths[0]) as img:
+        config = bench_config(img.size, DEFAULT_ROTATIONS[-1])
+    output_folder = tempfile.mkdtemp(prefix="watermark_bench_")
+
+    def export():
+        # 导出进度输出到stderr，stdout只保留结果
+        with contextlib.redirect_stdout(sys.stderr):
+            failures = watermark_cli.run_export(paths, config, output_folder, jobs=jobs)
+        if failures:
+            raise RuntimeError(f"导出失败: {failures[0]}")
+
+    try:
+        timings = _timings(export, repeat)
+    finally:
+        shutil.rmtree(output_folder, ignore_errors=True)
+    case = {'images': len(paths), 'jobs': jobs, 'input_mb': round(nbytes / 1e6, 1)}
+    return _result('export', case, timings, len(paths), nbytes)
+
+
+def _run_isolated(fn, *args):
+    """在新的子进程中运行测试用例，使内存峰值只反映该用例"""
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def run_benchmarks(paths, benches, rotations=DEFAULT_ROTATIONS, jobs_list=DEFAULT_JOBS, repeat=3,
+                   log=None):
+    """运行选定的测试，返回结果列表"""
+    results = []
+
+    def add(result):
+        for item in (result if isinstance(result, list) else [result]):
+            results.append(item)
+            if log:
+                log(item)
+
+    for path in paths:
+        if 'render' in benches:
+            for rotation in rotations:
+                add(_run_isolated(run_render, path, rotation, repeat))
+        if 'tiled' in benches:
+            for rotation in rotations:
+                add(_run_isolated(run_render, path, rotation, repeat, True))
+        if 'legacy' in benches:
+            for rotation in rotations:
+                for variant in ('native', 'legacy'):
+                    add(_run_isolated(run_export_prepare, path, rotation, variant, repeat))
+        if 'preview' in benches:
+            add(_run_isolated(run_preview, path, repeat))
+        if 'encode' in benches:
+            for output_format in watermark_engine.OUTPUT_FORMATS:
+                for preset in (None, *watermark_engine.ENCODER_PRESETS):
+                    add(_run_isolated(run_encode, path, output_format, preset, repeat))
+    if 'export' in benches:
+        for jobs in jobs_list:
+            add(_run_isolated(run_export, paths, jobs, repeat))
+    return results
+
+
+def environment():
+    """测试环境信息"""
+    return {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'render_version': watermark_engine.RENDER_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def _format_result(result):
+    """单行结果摘要"""
+    case = result['case']
+    label = case.get('image') or f"{case['images']} 张图片"
+    details = ', '.join(f"{key}={case[key]}" for key in ('rotation', 'variant', 'stage', 'output_format', 'preset',
+                                                        'output_bytes', 'jobs') if key in case)
+    rss = f", 内存峰值 {result['peak_rss_mb']} MB" if result['peak_rss_mb'] is not None else ""
+    return (f"[{result['bench']}] {label} ({details}): {result['seconds'] * 1000:.1f} ms, "
+            f"{result['images_per_sec']} 张/秒, {result['mb_per_sec']} MB/秒{rss}")
+
+
+def _parse_list(value, cast):
+    return tuple(cast(item) for item in value.split(',') if item)
+
+
+def build_parser():
+    """构建命令行参数解析器"""
+    parser = argparse.ArgumentParser(description="照片水印工具 - 性能基准测试")
+    parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "watermark_bench_corpus"),
+                        help="合成图片集所在文件夹（不存在时生成，已有的图片直接复用）")
+    parser.add_argument("--sizes", default=','.join(map(str, DEFAULT_SIZES)),
+                        help="图片尺寸列表，单位百万像素（默认1,12,50,100）")
+    parser.add_argument("--formats", default=','.join(ext.lstrip('.') for ext in DEFAULT_FORMATS),
+                        help="图片格式列表（默认jpg,png,tiff）")
+    parser.add_argument("--rotations", default=','.join(map(str, DEFAULT_ROTATIONS)),
+                        help="水印旋转角度列表（默认0,30）")
+    parser.add_argument("--jobs", default=','.join(map(str, DEFAULT_JOBS)),
+                        help="批量导出测试的进程数列表（默认1,2,4）")
+    parser.add_argument("--bench", default="render,tiled,legacy,preview,encode,export",
+                        help="要运行的测试（render, tiled, legacy, preview, encode, export）")
+    parser.add_argument("--repeat", type=int, default=3, help="每个用例重复次数，取中位数（默认3）")
+    parser.add_argument("-o", "--output", help="结果JSON文件（默认输出到stdout）")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    sizes = _parse_list(args.sizes, int)
+    formats = _parse_list(args.formats, lambda ext: '.' + ext.lower().lstrip('.'))
+
+    print(f"准备合成图片集: {args.corpus}", file=sys.stderr)
+    paths = make_corpus(args.corpus, sizes, formats)
+
+    results = run_benchmarks(paths, set(_parse_list(args.bench, str)),
+                             rotations=_parse_list(args.rotations, int),
+                             jobs_list=_parse_list(args.jobs, int), repeat=args.repeat,
+                             log=lambda result: print(_format_result(result), file=sys.stderr))
+
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.output}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+命令行批量水印工具 - 无需图形界面，适合在服务器上批量处理大量图片
+"""
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import watermark_engine
+import watermark_manifest
+import watermark_pipeline
+import watermark_scan
+import watermark_server
+import watermark_shard
+import watermark_watch
+
+
+def collect_images(inputs, recursive=True):
+    """展开输入路径：文件直接加入，文件夹扫描其中支持的图片"""
+    images = []
+    for path in inputs:
+        if os.path.isdir(path):
+            # 扫描结果按目录列出的顺序返回，排序后导出顺序固定
+            images.extend(sorted(watermark_scan.iter_image_files(path, recursive)))
+        elif os.path.isfile(path):
+            images.append(path)
+        else:
+            print(f"⚠️  跳过不存在的路径: {path}", file=sys.stderr)
+    return images
+
+
+def run_export(images, config, output_folder, jobs=None, settings=None, on_success=None):
+    """导出所有图片，返回失败列表[(路径, 错误信息)]
+
+    读取和写入在主进程的I/O线程中进行，解码、添加水印和编码在进程池中进行。
+    输出文件写完整并同步到磁盘后才改名为最终文件名。
+    每张图片导出成功后调用on_success(路径)（在主进程中）。
+    """
+    jobs = jobs or os.cpu_count() or 1
+    total = len(images)
+    failures = []
+    start_time = time.time()
+    done = 0
+
+    def on_done(_, img_path, output_path, error):
+        nonlocal done
+        done += 1
+        if error:
+            failures.append((img_path, error))
+            print(f"❌ {img_path}: {error}", file=sys.stderr)
+        elif on_success:
+            on_success(img_path)
+        if done % 100 == 0 or done == total:
+            elapsed = time.time() - start_time
+            rate = done / elapsed if elapsed > 0 else 0
+            print(f"进度: {done}/{total} ({rate:.1f} 张/秒)")
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pipeline = watermark_pipeline.ExportPipeline(output_folder, settings=settings, cpu_workers=jobs,
+                                                     cpu_executor=executor, fsync=True)
+        pipeline.run(((img_path, config, None) for img_path in images), on_done=on_done)
+    return failures
+
+
+def template_config(args):
+    """读取参数指定的模板，模板不存在时返回None"""
+    templates = watermark_engine.load_templates(args.templates)
+    if args.template not in templates:
+        print(f"❌ 模板 '{args.template}' 不存在，可用模板: {', '.join(templates) or '无'}", file=sys.stderr)
+        return None
+    return watermark_engine.config_from_template(templates[args.template])
+
+
+def export_settings_from_args(args):
+    """根据命令行参数生成导出设置"""
+    return watermark_engine.export_settings(
+        args.preset, format=args.format, quality=args.quality, optimize=args.optimize,
+        progressive=args.progressive, subsampling=args.subsampling, compress_level=args.compress_level)
+
+
+def cmd_export(args):
+    """export子命令"""
+    config = template_config(args)
+    if config is None:
+        return 2
+
+    images = collect_images(args.inputs, recursive=not args.no_recursive)
+    if not images:
+        print("❌ 没有找到可处理的图片", file=sys.stderr)
+        return 2
+
+    os.makedirs(args.output, exist_ok=True)
+    settings = export_settings_from_args(args)
+
+    # 增量导出：跳过原图和配置都未变化的输出（包括上次被中断的导出中已完成的图片）
+    watermark_pipeline.remove_partial_outputs(args.output)
+    manifest = watermark_manifest.ExportManifest(args.output, content_hash=args.hash)
+    spec = export_args(args)
+    resume = not args.force and same_export(manifest.interrupted, spec)
+    if resume:
+        print("继续上次被中断的导出")
+    manifest.begin_run(resume=resume, settings=settings, cli=spec)
+    pending, skipped = manifest.plan(((img_path, config) for img_path in images),
+                                     force=args.force, settings=settings)
+    if skipped:
+        print(f"跳过 {skipped} 张未变化的图片")
+    if not pending:
+        manifest.finish()
+        print("✅ 所有图片都是最新的，无需导出")
+        return 0
+
+    tasks = {img_path: (cfg_hash, fingerprint) for img_path, _, cfg_hash, fingerprint in pending}
+
+    def on_success(img_path):
+        cfg_hash, fingerprint = tasks[img_path]
+        output_path = watermark_engine.output_path_for(img_path, args.output, output_format=settings['format'])
+        manifest.record(img_path, output_path, cfg_hash, fingerprint)
+
+    print(f"开始导出 {len(pending)} 张图片，模板 '{args.template}'，{args.jobs or os.cpu_count()} 个进程")
+    start_time = time.time()
+    try:
+        failures = run_export(list(tasks), config, args.output, jobs=args.jobs,
+                              settings=settings, on_success=on_success)
+    except BaseException:
+        # 保留导出日志，之后可以用resume子命令继续
+        manifest.close()
+        raise
+    manifest.finish()
+    elapsed = time.time() - start_time
+
+    succeeded = len(pending) - len(failures)
+    print(f"✅ 导出完成: {succeeded} 张成功, {len(failures)} 张失败, {skipped} 张跳过, 用时 {elapsed:.1f} 秒")
+    return 1 if failures else 0
+
+
+def export_args(args):
+    """export子命令的参数（记录在导出日志中，resume子命令据此继续导出，路径转换为绝对路径）"""
+    spec = {key: value for key, value in vars(args).items() if key not in ('func', 'command')}
+    spec['inputs'] = [os.path.abspath(path) for path in args.inputs]
+    spec['templates'] = os.path.abspath(args.templates)
+    return spec
+
+
+def same_export(run, spec):
+    """被中断的导出（导出日志开头记录的信息）是否与本次参数相同（不比较进程数等不影响输出的参数）"""
+    if not run or 'cli' not in run:
+        return False
+    ignored = ('jobs', 'force', 'output')
+    strip = lambda cli: {key: value for key, value in cli.items() if key not in ignored}
+    return strip(run['cli']) == strip(spec)
+
+
+def cmd_resume(args):
+    """resume子命令：使用上次被中断的导出的参数继续导出"""
+    run = watermark_manifest.interrupted_run(args.output)
+    if not run or 'cli' not in run:
+        print(f"❌ {args.output} 中没有可以继续的导出", file=sys.stderr)
+        return 2
+    resumed = argparse.Namespace(**run['cli'])
+    resumed.output = args.output
+    resumed.force = False
+    if args.jobs:
+        resumed.jobs = args.jobs
+    return cmd_export(resumed)
+
+
+def cmd_job_create(args):
+    """job-create子命令：创建分片导出任务"""
+    config = template_config(args)
+    if config is None:
+        return 2
+    images = collect_images(args.inputs, recursive=not args.no_recursive)
+    if not images:
+        print("❌ 没有找到可处理的图片", file=sys.stderr)
+        return 2
+    shards = watermark_shard.create_job(args.job, ((img_path, config) for img_path in images), args.output,
+                                        settings=export_settings_from_args(args), shard_size=args.shard_size)
+    print(f"✅ 已创建任务 {args.job}: {len(images)} 张图片，{shards} 个分片")
+    return 0
+
+
+def cmd_worker(args):
+    """worker子命令：认领并处理分片，直到任务全部完成"""
+    jobs = args.jobs or os.cpu_count() or 1
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        worker = watermark_shard.ShardWorker(args.job, cpu_workers=jobs, cpu_executor=executor,
+                                             lease_seconds=args.lease)
+        print(f"工作进程 {worker.worker_id} 开始处理任务 {args.job}，{jobs} 个进程")
+        shards, succeeded, failed = worker.run()
+    print(f"✅ 任务已全部完成：本进程处理 {shards} 个分片，{succeeded} 张成功，{failed} 张失败，"
+          f"用时 {time.time() - start_time:.1f} 秒")
+    return 1 if failed else 0
+
+
+def cmd_job_status(args):
+    """job-status子命令：显示分片导出任务的进度"""
+    status = watermark_shard.job_status(args.job, lease_seconds=args.lease)
+    print(f"分片: {status['done']}/{status['shards']} 已完成，{status['leased']} 处理中，{status['pending']} 等待中")
+    print(f"图片: {status['succeeded']} 张成功，{status['failed']} 张失败")
+    return 0
+
+
+def cmd_watch(args):
+    """watch子命令：监视文件夹，新图片写完后立即导出，直到Ctrl+C或SIGTERM"""
+    config = template_config(args)
+    if config is None:
+        return 2
+    jobs = args.jobs or os.cpu_count() or 1
+    failures = 0
+
+    def on_done(img_path, output_path, error, latency):
+        nonlocal failures
+        if error:
+            failures += 1
+            print(f"❌ {img_path}: {error}", file=sys.stderr)
+        else:
+            print(f"✅ {os.path.basename(img_path)} -> {output_path} ({latency:.2f} 秒)")
+
+    # 子进程忽略Ctrl+C，由主进程停止监视并等待正在处理的图片完成
+    with ProcessPoolExecutor(max_workers=jobs, initializer=signal.signal,
+                             initargs=(signal.SIGINT, signal.SIG_IGN)) as executor:
+        service = watermark_watch.WatchService(
+            args.input, args.output, config, settings=export_settings_from_args(args), cpu_workers=jobs,
+            cpu_executor=executor, recursive=not args.no_recursive, polling=args.poll,
+            poll_interval=args.interval, settle_seconds=args.settle, write_timeout=args.write_timeout)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: service.stop())
+        mode = "定期扫描" if service.polling else "inotify"
+        print(f"正在监视 {service.input_folder}（{mode}），输出到 {service.output_folder}，按Ctrl+C停止")
+        succeeded, failed = service.run(on_done=on_done)
+    print(f"已停止监视：{succeeded} 张成功，{failed} 张失败")
+    return 0
+
+
+def cmd_serve(args):
+    """serve子命令：启动本地HTTP水印服务，直到Ctrl+C或SIGTERM"""
+    templates = watermark_engine.load_templates(args.templates)
+    server = watermark_server.WatermarkServer(templates, workers=args.jobs, concurrency=args.concurrency,
+                                              max_queue=args.max_queue, threads=args.threads,
+                                              max_body=args.max_body)
+
+    def on_ready(address):
+        pool = "线程" if server.threads else "进程"
+        print(f"水印服务已启动: http://{address[0]}:{address[1]}/watermark，{server.workers} 个{pool}，"
+              f"最多同时处理 {server.concurrency} 个请求、排队 {server.max_queue} 个，按Ctrl+C停止")
+
+    asyncio.run(server.serve(args.host, args.port, on_ready=on_ready))
+    stats = server.stats
+    print(f"服务已停止：完成 {stats['completed']} 个请求，失败 {stats['failed']} 个，拒绝 {stats['rejected']} 个")
+    return 0
+
+
+def add_settings_arguments(parser):
+    """添加导出设置参数"""
+    parser.add_argument("--format", choices=sorted(watermark_engine.OUTPUT_FORMATS),
+                        help="输出格式（默认保持原图格式）")
+    parser.add_argument("--preset", choices=sorted(watermark_engine.ENCODER_PRESETS),
+                        help="编码预设：fast（最快）、balanced（均衡）、smallest（文件最小）")
+    parser.add_argument("--quality", type=int, default=None, help="JPEG/WebP质量（默认95，或预设的质量）")
+    parser.add_argument("--optimize", action="store_true", default=None, help="JPEG优化霍夫曼表")
+    parser.add_argument("--progressive", action="store_true", default=None, help="JPEG渐进式编码")
+    parser.add_argument("--subsampling", choices=("4:4:4", "4:2:2", "4:2:0"), help="JPEG色度抽样")
+    parser.add_argument("--compress-level", type=int, choices=range(10), metavar="0-9",
+                        help="PNG压缩级别（默认6，0最快，9最小）")
+
+
+def build_parser():
+    """构建命令行参数解析器"""
+    parser = argparse.ArgumentParser(description="照片水印工具 - 命令行批量处理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="使用模板批量导出水印图片")
+    export_parser.add_argument("inputs", nargs="+", help="输入图片文件或文件夹")
+    export_parser.add_argument("-t", "--template", required=True, help="templates.json中的模板名称")
+    export_parser.add_argument("-o", "--output", required=True, help="输出文件夹")
+    export_parser.add_argument("-j", "--jobs", type=int, default=None, help="工作进程数（默认CPU核心数）")
+    export_parser.add_argument("--templates", default="templates.json", help="模板文件路径（默认templates.json）")
+    add_settings_arguments(export_parser)
+    export_parser.add_argument("--no-recursive", action="store_true", help="不扫描子文件夹")
+    export_parser.add_argument("--force", action="store_true", help="忽略导出清单，重新导出所有图片")
+    export_parser.add_argument("--hash", action="store_true", help="用文件内容哈希判断原图是否变化（较慢但更准确）")
+    export_parser.set_defaults(func=cmd_export)
+
+    resume_parser = subparsers.add_parser("resume", help="继续输出文件夹中被中断的导出")
+    resume_parser.add_argument("-o", "--output", required=True, help="输出文件夹")
+    resume_parser.add_argument("-j", "--jobs", type=int, default=None, help="工作进程数（默认使用原来的设置）")
+    resume_parser.set_defaults(func=cmd_resume)
+
+    job_parser = subparsers.add_parser("job-create", help="创建分片导出任务（多台机器共同处理）")
+    job_parser.add_argument("inputs", nargs="+", help="输入图片文件或文件夹")
+    job_parser.add_argument("-t", "--template", required=True, help="templates.json中的模板名称")
+    job_parser.add_argument("-o", "--output", required=True, help="输出文件夹（所有机器上路径相同）")
+    job_parser.add_argument("--job", required=True, help="任务文件夹（所有机器都能访问的共享文件夹）")
+    job_parser.add_argument("--templates", default="templates.json", help="模板文件路径（默认templates.json）")
+    job_parser.add_argument("--shard-size", type=int, default=watermark_shard.DEFAULT_SHARD_SIZE,
+                            help=f"每个分片的图片数量（默认{watermark_shard.DEFAULT_SHARD_SIZE}）")
+    add_settings_arguments(job_parser)
+    job_parser.add_argument("--no-recursive", action="store_true", help="不扫描子文件夹")
+    job_parser.set_defaults(func=cmd_job_create)
+
+    worker_parser = subparsers.add_parser("worker", help="处理分片导出任务，可在多台机器上同时运行")
+    worker_parser.add_argument("--job", required=True, help="任务文件夹")
+    worker_parser.add_argument("-j", "--jobs", type=int, default=None, help="工作进程数（默认CPU核心数）")
+    worker_parser.add_argument("--lease", type=float, default=watermark_shard.DEFAULT_LEASE_SECONDS,
+                               help=f"租约时长（秒，默认{watermark_shard.DEFAULT_LEASE_SECONDS}），"
+                                    "工作进程失联超过该时长后分片由其他工作进程接管")
+    worker_parser.set_defaults(func=cmd_worker)
+
+    status_parser = subparsers.add_parser("job-status", help="显示分片导出任务的进度")
+    status_parser.add_argument("--job", required=True, help="任务文件夹")
+    status_parser.add_argument("--lease", type=float, default=watermark_shard.DEFAULT_LEASE_SECONDS,
+                               help="租约时长（秒），用于判断分片是否仍在处理中")
+    status_parser.set_defaults(func=cmd_job_status)
+
+    watch_parser = subparsers.add_parser("watch", help="监视文件夹，新增或修改的图片写完后立即导出")
+    watch_parser.add_argument("input", help="监视的输入文件夹")
+    watch_parser.add_argument("-t", "--template", required=True, help="templates.json中的模板名称")
+    watch_parser.add_argument("-o", "--output", required=True, help="输出文件夹")
+    watch_parser.add_argument("-j", "--jobs", type=int, default=None, help="工作进程数（默认CPU核心数）")
+    watch_parser.add_argument("--templates", default="templates.json", help="模板文件路径（默认templates.json）")
+    add_settings_arguments(watch_parser)
+    watch_parser.add_argument("--no-recursive", action="store_true", help="不监视子文件夹")
+    watch_parser.add_argument("--poll", action="store_true", help="定期扫描文件夹（不使用inotify，如网络文件夹）")
+    watch_parser.add_argument("--interval", type=float, default=watermark_watch.DEFAULT_POLL_INTERVAL,
+                              help=f"定期扫描的间隔（秒，默认{watermark_watch.DEFAULT_POLL_INTERVAL}）")
+    watch_parser.add_argument("--settle", type=float, default=watermark_watch.DEFAULT_SETTLE_SECONDS,
+                              help="定期扫描时，文件大小保持不变多久后视为写完"
+                                   f"（秒，默认{watermark_watch.DEFAULT_SETTLE_SECONDS}）")
+    watch_parser.add_argument("--write-timeout", type=float, default=watermark_watch.DEFAULT_WRITE_TIMEOUT,
+                              help="inotify下迟迟没有关闭事件的文件，保持不变多久后仍然处理"
+                                   f"（秒，默认{watermark_watch.DEFAULT_WRITE_TIMEOUT:g}）")
+    watch_parser.set_defaults(func=cmd_watch)
+
+    serve_parser = subparsers.add_parser("serve", help="启动本地HTTP水印服务")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="监听地址（默认127.0.0.1）")
+    serve_parser.add_argument("--port", type=int, default=8080, help="监听端口（默认8080）")
+    serve_parser.add_argument("-j", "--jobs", type=int, default=None, help="工作进程数（默认CPU核心数）")
+    serve_parser.add_argument("--threads", action="store_true", help="使用线程池代替进程池")
+    serve_parser.add_argument("--concurrency", type=int, default=None,
+                              help="同时处理的请求数（默认等于工作进程数）")
+    serve_parser.add_argument("--max-queue", type=int, default=None,
+                              help="额外允许排队的请求数，超出时返回503（默认并发数的4倍）")
+    serve_parser.add_argument("--max-body", type=int, default=watermark_server.DEFAULT_MAX_BODY,
+                              help="最大上传大小（字节）")
+    serve_parser.add_argument("--templates", default="templates.json", help="模板文件路径（默认templates.json）")
+    serve_parser.set_defaults(func=cmd_serve)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
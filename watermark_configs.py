@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+每张图片的水印配置存储 - 共享只读模板，每张图片只保存与模板不同的字段
+"""
+
+_MISSING = object()
+
+
+class FrozenConfig(dict):
+    """只读的水印配置，可在多张图片和多个线程间共享
+
+    仍是dict的子类，可以直接传给渲染引擎、序列化为JSON或跨进程传递；
+    需要修改时先用copy()得到普通字典。
+    """
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenConfig是只读的，请先用copy()复制")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+    def copy(self):
+        """返回可修改的普通字典"""
+        return dict(self)
+
+    def __reduce__(self):
+        return (FrozenConfig, (dict(self),))
+
+
+class ImageConfigEntry:
+    """单张图片的配置：基准模板和与之不同的字段（没有不同时为None）"""
+
+    __slots__ = ('generation', 'base', 'overrides')
+
+    def __init__(self, generation, base, overrides):
+        self.generation = generation
+        self.base = base
+        self.overrides = overrides
+
+
+class ConfigStore:
+    """图片路径到水印配置的映射
+
+    没有单独设置过的图片直接使用公共模板（不占用额外内存）；单独修改过的图片
+    只保存被修改的字段。apply_to_all()只替换公共模板并使旧的单独设置失效，
+    与图片数量无关，失效的记录在下次访问时才清理。
+    """
+
+    def __init__(self, default_config):
+        self.default = freeze(default_config)
+        self._base = self.default
+        self._generation = 0
+        self._entries = {}
+
+    @property
+    def base(self):
+        """当前的公共模板"""
+        return self._base
+
+    def _entry(self, path):
+        """返回仍然有效的单独设置，失效的记录顺便删除"""
+        entry = self._entries.get(path)
+        if entry is not None and entry.generation != self._generation:
+            del self._entries[path]
+            return None
+        return entry
+
+    def get(self, path):
+        """返回图片的完整配置（只读）"""
+        entry = self._entry(path)
+        if entry is None:
+            return self._base
+        if entry.overrides is None:
+            return entry.base
+        merged = dict(entry.base)
+        merged.update(entry.overrides)
+        return FrozenConfig(merged)
+
+    def __contains__(self, path):
+        """图片是否有单独设置"""
+        return self._entry(path) is not None
+
+    def set(self, path, config):
+        """保存图片的配置，只记录与其基准模板不同的字段"""
+        entry = self._entry(path)
+        base = entry.base if entry is not None else self._base
+        overrides = {}
+        for key, value in config.items():
+            if isinstance(value, list):
+                value = tuple(value)
+            if base.get(key, _MISSING) != value:
+                overrides[key] = value
+        if not overrides and base is self._base:
+            self._entries.pop(path, None)
+            return
+        self._entries[path] = ImageConfigEntry(self._generation, base, overrides or None)
+
+    def apply(self, path, template):
+        """把模板应用到单张图片（丢弃该图片之前的单独设置）"""
+        self._entries[path] = ImageConfigEntry(self._generation, self._merged(template), None)
+
+    def apply_to_all(self, template):
+        """把模板应用到所有图片：替换公共模板，所有单独设置失效"""
+        self._base = self._merged(template)
+        self._generation += 1
+
+    def reset(self, path):
+        """删除图片的单独设置，恢复使用公共模板"""
+        self._entries.pop(path, None)
+
+    def overridden(self):
+        """返回有单独设置的图片路径列表"""
+        return [path for path, entry in list(self._entries.items())
+                if entry.generation == self._generation]
+
+    def _merged(self, template):
+        """以默认配置为基础合并模板，保证所有字段齐全"""
+        if isinstance(template, FrozenConfig) and template.keys() >= self.default.keys():
+            return template
+        merged = dict(self.default)
+        merged.update(template)
+        return freeze(merged)
+
+
+def freeze(config):
+    """把配置转换为只读配置（颜色和位置统一为元组）"""
+    if isinstance(config, FrozenConfig):
+        return config
+    config = dict(config)
+    for key in ('font_color', 'position'):
+        if isinstance(config.get(key), list):
+            config[key] = tuple(config[key])
+    return FrozenConfig(config)
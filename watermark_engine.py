@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+水印渲染引擎 - 不依赖tkinter，供图形界面、命令行和后台批量导出共用
+"""
+
+import io
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, UnidentifiedImageError
+
+import watermark_fonts
+import watermark_stamps
+import watermark_trace
+
+# 渲染算法版本：输出结果发生变化时递增，使增量导出清单中的旧记录失效
+RENDER_VERSION = 1
+
+# 支持导入的图片格式
+SUPPORTED_FORMATS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff')
+
+# 可以直接合成水印的图片模式（其余模式先转换为最接近的模式）
+NATIVE_MODES = ('RGB', 'RGBA', 'L', 'LA', 'CMYK', 'I;16', 'I')
+
+# 预览可以直接显示的图片模式
+PREVIEW_MODES = ('RGB', 'RGBA', 'L')
+
+# 各输出格式可以直接保存的图片模式
+SAVE_MODES = {
+    '.jpg': ('RGB', 'L', 'CMYK'),
+    '.jpeg': ('RGB', 'L', 'CMYK'),
+    '.png': ('RGB', 'RGBA', 'L', 'LA', 'I;16', 'I'),
+    '.bmp': ('RGB', 'L'),
+    '.tiff': ('RGB', 'RGBA', 'L', 'LA', 'CMYK', 'I;16', 'I'),
+    '.tif': ('RGB', 'RGBA', 'L', 'LA', 'CMYK', 'I;16', 'I'),
+    '.webp': ('RGB', 'RGBA'),
+}
+
+# 可选的输出格式及其扩展名（None表示保持原图格式）
+OUTPUT_FORMATS = {
+    'jpeg': '.jpg',
+    'png': '.png',
+    'webp': '.webp',
+    'tiff': '.tiff',
+}
+
+# 默认导出设置：与各编码器的默认参数一致，质量95
+DEFAULT_EXPORT_SETTINGS = {
+    'format': None,
+    'quality': 95,
+    'optimize': False,
+    'progressive': False,
+    'subsampling': None,
+    'compress_level': 6,
+    'webp_method': 4,
+    'tiff_compression': None,
+}
+
+# 各编码器使用的导出设置（与encoder_options()一致）
+ENCODER_SETTINGS = {
+    'JPEG': ('quality', 'optimize', 'progressive', 'subsampling'),
+    'PNG': ('compress_level',),
+    'WEBP': ('quality', 'webp_method'),
+    'TIFF': ('tiff_compression',),
+}
+
+# 编码速度预设（12百万像素合成图片实测，见README）：
+#   fast     - 最快：JPEG不做霍夫曼优化，PNG最低压缩级别，WebP最快方法，TIFF不压缩
+#   balanced - 均衡：JPEG优化霍夫曼表，PNG中等压缩级别，TIFF使用Deflate压缩
+#   smallest - 最小：JPEG渐进式并降低质量，PNG最高压缩级别，WebP最慢方法，TIFF使用Deflate压缩
+ENCODER_PRESETS = {
+    'fast': {
+        'quality': 90, 'optimize': False, 'progressive': False, 'subsampling': '4:2:0',
+        'compress_level': 1, 'webp_method': 0, 'tiff_compression': None,
+    },
+    'balanced': {
+        'quality': 90, 'optimize': True, 'progressive': False, 'subsampling': '4:2:0',
+        'compress_level': 4, 'webp_method': 4, 'tiff_compression': 'tiff_adobe_deflate',
+    },
+    'smallest': {
+        'quality': 80, 'optimize': True, 'progressive': True, 'subsampling': '4:2:0',
+        'compress_level': 9, 'webp_method': 6, 'tiff_compression': 'tiff_adobe_deflate',
+    },
+}
+
+# 默认水印配置
+DEFAULT_WATERMARK_CONFIG = {
+    'text': '水印文字',
+    'font_size': 24,
+    'font_color': (255, 0, 0),
+    'opacity': 80,
+    'position': (50, 50),
+    'rotation': 0,
+    'tiled': False,
+    'tile_spacing': 100
+}
+
+
+def load_font(font_size):
+    """加载字体（支持中文），使用全局字体缓存"""
+    return watermark_fonts.get_font(font_size)
+
+
+def working_mode(img):
+    """返回合成水印时使用的图片模式：能直接合成的模式保持不变，其余转换为最接近的模式"""
+    mode = img.mode
+    if mode in NATIVE_MODES:
+        return mode
+    if mode.startswith('I;16'):
+        return 'I'
+    if mode == '1':
+        return 'L'
+    if mode in ('PA', 'La') or 'transparency' in img.info:
+        return 'RGBA'
+    return 'RGB'
+
+
+def _ink_for_mode(color, mode):
+    """把RGB水印颜色换算为指定图片模式下的像素值"""
+    rgb = tuple(color[:3])
+    if mode == 'RGB':
+        return rgb
+    if mode == 'I;16' or mode == 'I':
+        # 16位灰度：把8位亮度扩展到0-65535
+        return Image.new('RGB', (1, 1), rgb).convert('L').getpixel((0, 0)) * 257
+    if mode == 'LA':
+        return (Image.new('RGB', (1, 1), rgb).convert('L').getpixel((0, 0)), 255)
+    return Image.new('RGB', (1, 1), rgb).convert(mode).getpixel((0, 0))
+
+
+def stamp_region(image_size, stamp, x, y):
+    """计算图块放在(x, y)处时与图片重叠的区域
+
+    返回(图片上的区域, 图块上的对应区域)，没有重叠时返回None。
+    """
+    sprite = stamp.image
+    left = max(0, x)
+    top = max(0, y)
+    right = min(image_size[0], x + sprite.width)
+    bottom = min(image_size[1], y + sprite.height)
+    if right <= left or bottom <= top:
+        return None
+    return (left, top, right, bottom), (left - x, top - y, right - x, bottom - y)
+
+
+def composite_stamp(img, stamp, x, y):
+    """把水印图块合成到图片的(x, y)处，只处理两者重叠的区域，直接修改img"""
+    region = stamp_region(img.size, stamp, x, y)
+    if region is None:
+        return
+
+    box, source = region
+    sprite = stamp.image
+    with watermark_trace.span("composite", mode=img.mode):
+        if img.mode == 'RGBA':
+            img.alpha_composite(sprite, dest=box[:2], source=source)
+        else:
+            # 其他模式：用图块的alpha通道作为蒙版，把水印颜色直接填充到原图
+            mask = stamp.mask
+            if source != (0, 0, sprite.width, sprite.height):
+                mask = mask.crop(source)
+            img.paste(_ink_for_mode(stamp.color, img.mode), box, mask)
+
+
+def _tile_strip(stamp, width, first_x, step, use_mask):
+    """生成一行平铺的水印条：从first_x开始每隔step粘贴一个图块，宽度与图片相同"""
+    sprite = stamp.mask if use_mask else stamp.image
+    strip = Image.new(sprite.mode, (width, sprite.height), 0)
+    for x in range(first_x, width, step):
+        strip.paste(sprite, (x, 0))
+    return strip
+
+
+def composite_tiled(img, stamp, x, y, spacing):
+    """以(x, y)处的图块为基准，把水印平铺到整张图片，直接修改img
+
+    相邻两行错开半个图块形成斜向排列。每种错位的水印条只生成一次，
+    之后逐行整条合成，耗时只与行数有关，与水印个数和文字绘制无关。
+    """
+    sprite = stamp.image
+    step_x = sprite.width + max(0, spacing)
+    step_y = sprite.height + max(0, spacing)
+    width, height = img.size
+    use_mask = img.mode != 'RGBA'
+    ink = _ink_for_mode(stamp.color, img.mode) if use_mask else None
+
+    # 覆盖图片的第一行及其相对基准行的奇偶
+    first_row = (-y - sprite.height) // step_y + 1
+    strips = {}
+    with watermark_trace.span("composite.tiled", mode=img.mode, spacing=spacing):
+        row = first_row
+        while True:
+            top = y + row * step_y
+            if top >= height:
+                break
+            parity = row % 2
+            strip = strips.get(parity)
+            if strip is None:
+                offset = x + parity * (step_x // 2)
+                strip = strips[parity] = _tile_strip(stamp, width, offset % step_x - step_x, step_x, use_mask)
+            # 水印条超出图片上下边缘的部分裁掉
+            source_top = max(0, -top)
+            source_bottom = min(sprite.height, height - top)
+            dest_top = top + source_top
+            if use_mask:
+                mask = strip
+                if source_top or source_bottom != sprite.height:
+                    mask = strip.crop((0, source_top, width, source_bottom))
+                img.paste(ink, (0, dest_top, width, dest_top + mask.height), mask)
+            else:
+                img.alpha_composite(strip, dest=(0, dest_top), source=(0, source_top, width, source_bottom))
+            row += 1
+
+
+def place_watermark(image_size, config, scale=1.0):
+    """计算水印图块及其在图片上的粘贴位置
+
+    image_size为要绘制的图片尺寸（预览时为缩放后的尺寸），返回(图块, x, y)；
+    水印文本为空时返回None。
+    """
+    if not config['text']:
+        return None
+
+    # 按缩放比例计算水印位置和字体大小
+    pos_x, pos_y = config['position']
+    pos_x = int(pos_x * scale)
+    pos_y = int(pos_y * scale)
+    font_size = int(config['font_size'] * scale)
+
+    # 获取预先渲染好的水印图块（同一配置的图片共享）
+    stamp = watermark_stamps.get_stamp(config['text'], font_size, config['font_color'],
+                                       config['opacity'], config['rotation'])
+    sprite = stamp.image
+
+    if config['rotation'] != 0:
+        # 计算在原图中的粘贴位置（考虑旋转后的偏移）
+        paste_x = pos_x - (sprite.width - stamp.text_width) // 2
+        paste_y = pos_y - (sprite.height - stamp.text_height) // 2
+
+        # 确保粘贴位置在图片范围内（平铺时该位置只是平铺的基准点，不需要限制）
+        if not config.get('tiled'):
+            paste_x = max(0, min(paste_x, image_size[0] - sprite.width))
+            paste_y = max(0, min(paste_y, image_size[1] - sprite.height))
+    else:
+        # 与在(pos_x, pos_y)处直接绘制文字的位置一致
+        paste_x = pos_x + stamp.offset[0] - watermark_stamps.STAMP_PADDING
+        paste_y = pos_y + stamp.offset[1] - watermark_stamps.STAMP_PADDING
+
+    return stamp, paste_x, paste_y
+
+
+def open_for_preview(img_path, max_width, max_height):
+    """打开图片用于预览，返回(图片, 原图尺寸)
+
+    JPEG利用解码器的DCT缩放只解码到不小于预览尺寸的1/2、1/4或1/8分辨率，
+    其他格式按原尺寸解码。完整分辨率只在导出时解码。
+    """
+    img = Image.open(img_path)
+    full_size = img.size
+    if img.format == 'JPEG':
+        scale = min(max_width / img.width, max_height / img.height, 1.0)
+        img.draft(img.mode, (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+    with watermark_trace.span("decode.preview", format=img.format):
+        img.load()
+    return img, full_size
+
+
+def make_preview(img, max_width, max_height, full_size=None):
+    """生成不超过指定尺寸的预览图，返回(预览图, 缩放比例)
+
+    img可以是按缩小分辨率解码的图片，此时通过full_size给出原图尺寸，缩放比例
+    始终相对原图计算。预览图转换为可直接显示的模式（RGB、RGBA或L），不会放大原图。
+    """
+    full_width, full_height = full_size or img.size
+    scale = min(max_width / full_width, max_height / full_height, 1.0)
+    size = (max(1, int(full_width * scale)), max(1, int(full_height * scale)))
+
+    # 调色板和二值图片先转换，保证缩放时正确插值
+    if img.mode in ('P', 'PA', '1'):
+        img = img.convert(working_mode(img))
+    if size != img.size:
+        with watermark_trace.span("preview.resize", width=size[0], height=size[1]):
+            preview = img.resize(size, Image.Resampling.LANCZOS)
+    else:
+        preview = img.copy()
+
+    if preview.mode not in PREVIEW_MODES:
+        if preview.mode in ('I;16', 'I'):
+            preview = preview.point(lambda v: v / 257).convert('L')
+        elif preview.mode in ('LA', 'La'):
+            preview = preview.convert('RGBA')
+        else:
+            preview = preview.convert('RGB')
+    return preview, scale
+
+
+def render_watermark(img, config, scale=1.0, in_place=False):
+    """在图片上添加水印
+
+    config中的位置和字体大小均以原图像素为单位；预览时传入缩放比例scale，
+    导出时scale为1.0。水印直接合成到图片原有的模式（RGB、L、CMYK、16位灰度等），
+    不做RGBA往返转换。默认不修改传入的图片和配置，也不依赖任何共享状态，
+    可在多个线程中同时调用；in_place为True时直接在传入的图片上绘制
+    （仅当模式无需转换时），用于导出时避免多复制一份整图。
+    """
+    if not config['text']:
+        return img
+
+    mode = working_mode(img)
+    if mode != img.mode:
+        img = img.convert(mode)
+    elif not in_place:
+        img = img.copy()
+
+    stamp, paste_x, paste_y = place_watermark(img.size, config, scale)
+    if config.get('tiled'):
+        spacing = int(config.get('tile_spacing', DEFAULT_WATERMARK_CONFIG['tile_spacing']) * scale)
+        composite_tiled(img, stamp, paste_x, paste_y, spacing)
+    else:
+        composite_stamp(img, stamp, paste_x, paste_y)
+    return img
+
+
+def render_batch(items, scale=1.0, max_workers=None):
+    """并行渲染多张图片，items为[(图片, 配置), ...]，按输入顺序返回结果"""
+    items = list(items)
+    if len(items) <= 1 or max_workers == 1:
+        return [render_watermark(img, config, scale) for img, config in items]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda item: render_watermark(item[0], item[1], scale), items))
+
+
+def load_templates(template_file):
+    """加载模板文件，文件不存在时返回空字典"""
+    if not os.path.exists(template_file):
+        return {}
+    with open(template_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def config_from_template(template):
+    """以默认配置为基础合并模板，保证所有字段齐全"""
+    config = DEFAULT_WATERMARK_CONFIG.copy()
+    config.update(template)
+    config['font_color'] = tuple(config['font_color'])
+    config['position'] = tuple(config['position'])
+    return config
+
+
+def output_path_for(img_path, output_folder, suffix="_watermarked", output_format=None):
+    """生成输出文件路径：原文件名 + 后缀，扩展名为指定的输出格式（默认保留原扩展名）"""
+    filename = os.path.basename(img_path)
+    name, ext = os.path.splitext(filename)
+    if output_format:
+        ext = OUTPUT_FORMATS[output_format]
+    return os.path.join(output_folder, f"{name}{suffix}{ext}")
+
+
+def export_settings(preset=None, **overrides):
+    """生成完整的导出设置：默认设置，依次叠加预设和单独指定的选项（值为None的选项忽略）"""
+    settings = dict(DEFAULT_EXPORT_SETTINGS)
+    if preset:
+        settings.update(ENCODER_PRESETS[preset])
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    return settings
+
+
+def settings_signature(settings, ext):
+    """影响输出结果的导出设置（用于增量导出清单）
+
+    ext为输出文件的扩展名，只包含该格式的编码器使用的选项：有损格式（JPEG、WebP）的质量，
+    以及与默认值不同的其他选项。修改JPEG质量不会使PNG、TIFF输出过期。
+    """
+    settings = settings or DEFAULT_EXPORT_SETTINGS
+    keys = ENCODER_SETTINGS.get(Image.registered_extensions().get(ext.lower()), ())
+    return {key: value for key, value in settings.items()
+            if key == 'format' and value is not None
+            or key in keys and (key == 'quality' or value != DEFAULT_EXPORT_SETTINGS.get(key))}
+
+
+def encoder_options(image_format, settings):
+    """按编码器换算保存参数，只传递该格式支持的选项"""
+    if image_format == 'JPEG':
+        options = {'quality': settings['quality']}
+        if settings['optimize']:
+            options['optimize'] = True
+        if settings['progressive']:
+            options['progressive'] = True
+        if settings['subsampling']:
+            options['subsampling'] = settings['subsampling']
+        return options
+    if image_format == 'PNG':
+        # PNG的optimize只是强制使用最高压缩级别，由compress_level控制
+        return {'compress_level': settings['compress_level']}
+    if image_format == 'WEBP':
+        return {'quality': settings['quality'], 'method': settings['webp_method']}
+    if image_format == 'TIFF':
+        return {'compression': settings['tiff_compression']} if settings['tiff_compression'] else {}
+    return {}
+
+
+def convert_for_format(img, ext):
+    """把图片转换为输出格式能保存的模式：带透明通道的图片合成到白色背景上"""
+    allowed = SAVE_MODES.get(ext.lower())
+    if allowed is None or img.mode in allowed:
+        return img
+    if img.mode == 'RGBA':
+        rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+        rgb_img.paste(img, mask=img.getchannel('A'))
+        return rgb_img
+    if img.mode == 'LA':
+        l_img = Image.new('L', img.size, 255)
+        l_img.paste(img.getchannel('L'), mask=img.getchannel('A'))
+        return l_img
+    if img.mode in ('I;16', 'I'):
+        # 16位灰度降为8位
+        return img.point(lambda v: v / 257).convert('L')
+    return img.convert('RGB')
+
+
+def save_image(img, output, settings=None, icc_profile=None, ext=None):
+    """按输出格式保存图片，尽量保持原有模式（如PNG保留透明通道）
+
+    output可以是文件路径，也可以是文件对象（此时需要通过ext指定输出格式的扩展名）；
+    settings为export_settings()生成的导出设置，默认为DEFAULT_EXPORT_SETTINGS。
+    """
+    if ext is None:
+        ext = os.path.splitext(output)[1]
+    converted = convert_for_format(img, ext)
+    image_format = Image.registered_extensions().get(ext.lower())
+    save_kwargs = encoder_options(image_format, settings or DEFAULT_EXPORT_SETTINGS)
+    # 模式未改变时保留原图的色彩配置文件
+    if icc_profile and converted is img:
+        save_kwargs['icc_profile'] = icc_profile
+    with watermark_trace.span("encode", format=image_format, mode=converted.mode):
+        converted.save(output, format=image_format, **save_kwargs)
+
+
+def export_image(img_path, config, output_folder, settings=None):
+    """加载原图、添加水印并保存，返回输出文件路径"""
+    settings = settings or DEFAULT_EXPORT_SETTINGS
+    with Image.open(img_path) as original_img:
+        with watermark_trace.span("decode", format=original_img.format):
+            original_img.load()
+        icc_profile = original_img.info.get('icc_profile')
+        watermarked_img = render_watermark(original_img, config, in_place=True)
+        output_path = output_path_for(img_path, output_folder, output_format=settings['format'])
+        save_image(watermarked_img, output_path, settings, icc_profile=icc_profile)
+    return output_path
+
+
+def encode_watermarked(data, config, ext, settings=None):
+    """从内存中的原图文件内容解码、添加水印并编码为输出格式，返回编码后的字节
+
+    ext为输出格式的扩展名。不做任何文件读写，供流水线导出的CPU阶段使用
+    （可在线程或子进程中运行）。无法识别的图片抛出UnidentifiedImageError，信息中不含内存对象的repr。
+    """
+    try:
+        original_img = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        raise UnidentifiedImageError("cannot identify image file") from None
+    with original_img:
+        with watermark_trace.span("decode", format=original_img.format):
+            original_img.load()
+        icc_profile = original_img.info.get('icc_profile')
+        watermarked_img = render_watermark(original_img, config, in_place=True)
+        output = io.BytesIO()
+        save_image(watermarked_img, output, settings, icc_profile=icc_profile, ext=ext)
+    return output.getvalue()
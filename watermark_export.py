@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后台导出任务 - 在工作线程中批量导出，通过队列报告进度，支持中途取消
+"""
+
+import os
+import time
+import queue
+import threading
+
+import watermark_configs
+import watermark_engine
+import watermark_manifest
+import watermark_pipeline
+
+
+class ExportJob:
+    """后台导出任务
+
+    items为[(原图路径, 水印配置), ...]，启动时复制配置（只读配置直接共享），之后界面上的修改
+    不影响本次导出；settings为导出设置（见watermark_engine.export_settings()）。
+    进度事件放入events队列，由界面线程轮询读取，每个事件为字典：
+      {'type': 'progress', 'done', 'failed', 'total', 'skipped', 'rate', 'eta'}
+      {'type': 'error', 'path', 'error'}
+      {'type': 'finished', 'done', 'failed', 'total', 'skipped', 'cancelled', 'elapsed'}
+    cancel()后不再开始新的图片，正在处理的图片完成后任务结束。
+
+    每张图片完成后记录到导出日志，输出文件写完整后才改名为最终文件名；程序崩溃、断电或
+    取消后再次导出同一文件夹时（force=False）跳过已完成的图片，从中断处继续。
+    """
+
+    def __init__(self, items, output_folder, settings=None, workers=None, force=False):
+        self.items = [(img_path, config if isinstance(config, watermark_configs.FrozenConfig) else dict(config))
+                      for img_path, config in items]
+        self.output_folder = output_folder
+        self.settings = dict(settings or watermark_engine.DEFAULT_EXPORT_SETTINGS)
+        self.workers = workers or os.cpu_count() or 1
+        self.force = force
+        self.events = queue.Queue()
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="export-job", daemon=True)
+
+    def start(self):
+        """开始导出"""
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """请求取消（在图片之间停止）"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        """是否已请求取消"""
+        return self._cancelled.is_set()
+
+    def is_running(self):
+        """任务是否仍在进行"""
+        return self._thread.is_alive()
+
+    def _run(self):
+        """控制线程：规划增量导出，通过流水线读取、渲染和写入图片"""
+        start_time = time.time()
+        done = failed = skipped = total = 0
+        manifest = None
+        completed = False
+        try:
+            watermark_pipeline.remove_partial_outputs(self.output_folder)
+            manifest = watermark_manifest.ExportManifest(self.output_folder)
+            manifest.begin_run(settings=self.settings, total=len(self.items))
+            pending, skipped = manifest.plan(self.items, force=self.force, settings=self.settings)
+            total = len(pending)
+            export_start = time.time()
+            self._emit_progress(done, failed, total, skipped, export_start)
+
+            def on_done(task, img_path, output_path, error):
+                nonlocal done, failed
+                if error is not None:
+                    failed += 1
+                    self.events.put({'type': 'error', 'path': img_path, 'error': error})
+                else:
+                    done += 1
+                    _, _, cfg_hash, fingerprint = task
+                    manifest.record(img_path, output_path, cfg_hash, fingerprint)
+                self._emit_progress(done, failed, total, skipped, export_start)
+
+            pipeline = watermark_pipeline.ExportPipeline(self.output_folder, settings=self.settings,
+                                                         cpu_workers=self.workers, fsync=True)
+            pipeline.run(((task[0], task[1], task) for task in pending),
+                         on_done=on_done, cancel_event=self._cancelled)
+            completed = not self.cancelled
+        except Exception as e:
+            self.events.put({'type': 'error', 'path': None, 'error': str(e)})
+        finally:
+            if manifest is not None:
+                try:
+                    # 未完成时保留导出日志，下次导出从中断处继续
+                    if completed:
+                        manifest.finish()
+                    else:
+                        manifest.close()
+                except OSError as e:
+                    self.events.put({'type': 'error', 'path': None, 'error': f"保存导出清单失败: {e}"})
+            self.events.put({
+                'type': 'finished',
+                'done': done,
+                'failed': failed,
+                'total': total,
+                'skipped': skipped,
+                'cancelled': self.cancelled,
+                'elapsed': time.time() - start_time,
+            })
+
+    def _emit_progress(self, done, failed, total, skipped, start_time):
+        """发送进度事件（吞吐量和预计剩余时间）"""
+        elapsed = time.time() - start_time
+        processed = done + failed
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        eta = (total - processed) / rate if rate > 0 else None
+        self.events.put({
+            'type': 'progress',
+            'done': done,
+            'failed': failed,
+            'total': total,
+            'skipped': skipped,
+            'rate': rate,
+            'eta': eta,
+        })
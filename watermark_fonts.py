@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+字体解析与缓存 - 只探测一次可用字体，并用LRU缓存已加载的字体对象
+"""
+
+import threading
+from collections import OrderedDict
+from PIL import ImageFont
+
+import watermark_trace
+
+# 字体候选路径（按优先级，优先中文字体）
+FONT_CANDIDATES = (
+    "/System/Library/Fonts/PingFang.ttc",
+    "/System/Library/Fonts/STHeiti Light.ttc",
+    "/System/Library/Fonts/Arial Unicode MS.ttf",
+    "arial.ttf",
+    "/System/Library/Fonts/Arial.ttf",
+)
+
+# 探测字体时使用的字号
+_PROBE_SIZE = 12
+
+
+class FontResolver:
+    """字体解析器
+
+    第一次使用时按顺序探测候选路径，记住第一个可用的字体文件，之后不再尝试
+    打开失败的路径；加载过的字体按(路径, 字号)保存在有上限的LRU缓存中。
+    可在多个线程中共享使用。
+    """
+
+    def __init__(self, candidates=FONT_CANDIDATES, max_fonts=32):
+        self.candidates = tuple(candidates)
+        self.max_fonts = max_fonts
+        self._lock = threading.Lock()
+        self._fonts = OrderedDict()
+        self._font_path = None
+        self._probed = False
+        self.hits = 0
+        self.misses = 0
+
+    def resolve_path(self):
+        """返回第一个可用的字体路径（只探测一次），没有可用字体时返回None"""
+        if not self._probed:
+            with self._lock:
+                if not self._probed:
+                    with watermark_trace.span("font.resolve"):
+                        self._font_path = self._probe()
+                    self._probed = True
+        return self._font_path
+
+    def _probe(self):
+        """依次尝试候选字体路径"""
+        for font_path in self.candidates:
+            try:
+                ImageFont.truetype(font_path, _PROBE_SIZE)
+                return font_path
+            except Exception:
+                continue
+        return None
+
+    def get_font(self, font_size):
+        """获取指定字号的字体对象，命中缓存时直接返回"""
+        font_size = max(1, int(font_size))
+        font_path = self.resolve_path()
+        key = (font_path, font_size)
+
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                self.hits += 1
+                watermark_trace.count("font.cache_hit")
+                return font
+            self.misses += 1
+
+        with watermark_trace.span("font.load", size=font_size):
+            if font_path is None:
+                font = ImageFont.load_default()
+            else:
+                font = ImageFont.truetype(font_path, font_size)
+
+        with self._lock:
+            self._fonts[key] = font
+            self._fonts.move_to_end(key)
+            while len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+        return font
+
+    def stats(self):
+        """返回缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'font_path': self._font_path,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'cached_fonts': len(self._fonts),
+                'max_fonts': self.max_fonts,
+            }
+
+    def clear(self):
+        """清空缓存和统计，下次使用时重新探测字体"""
+        with self._lock:
+            self._fonts.clear()
+            self._font_path = None
+            self._probed = False
+            self.hits = 0
+            self.misses = 0
+
+
+# 全局共享的字体解析器
+default_resolver = FontResolver()
+
+
+def get_font(font_size):
+    """使用全局字体解析器获取字体"""
+    return default_resolver.get_font(font_size)
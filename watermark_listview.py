@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+虚拟化列表控件 - 只为可见的行创建列表项，图片数量再多也不影响界面速度
+"""
+
+import tkinter as tk
+from tkinter import ttk
+
+
+class VirtualListView(ttk.Frame):
+    """虚拟化列表
+
+    内部的Listbox只保存当前可见的height行，行文本由row_text(索引)按需生成，
+    滚动条按总行数换算。追加行（set_count）和按索引选中（select）都与总行数无关。
+    选中某行时调用on_select(索引)。
+    """
+
+    def __init__(self, parent, row_text, height=6, on_select=None, **kwargs):
+        super().__init__(parent, **kwargs)
+        self.row_text = row_text
+        self.height = height
+        self.on_select = on_select
+        self.count = 0
+        self.first = 0
+        self.selected = None
+
+        self.listbox = tk.Listbox(self, height=height, exportselection=False)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.listbox.bind('<<ListboxSelect>>', self._on_listbox_select)
+        self.listbox.bind('<MouseWheel>', self._on_mousewheel)
+        self.listbox.bind('<Button-4>', self._on_mousewheel)  # Linux
+        self.listbox.bind('<Button-5>', self._on_mousewheel)  # Linux
+        self.listbox.bind('<Up>', lambda e: self._move_selection(-1))
+        self.listbox.bind('<Down>', lambda e: self._move_selection(1))
+        self.listbox.bind('<Prior>', lambda e: self._move_selection(-self.height))
+        self.listbox.bind('<Next>', lambda e: self._move_selection(self.height))
+
+        self._update_scrollbar()
+
+    def set_count(self, count):
+        """设置总行数（追加行时只刷新可见区域受影响的部分）"""
+        old_count = self.count
+        self.count = count
+        if self.selected is not None and self.selected >= count:
+            self.selected = None
+        max_first = max(0, count - self.height)
+        if self.first > max_first:
+            self.first = max_first
+            self.refresh()
+        elif old_count < self.first + self.height or count < old_count:
+            # 可见区域未填满或行数减少时需要重新填充
+            self.refresh()
+        else:
+            self._update_scrollbar()
+
+    def refresh(self):
+        """重新生成可见行"""
+        last = min(self.count, self.first + self.height)
+        rows = [self.row_text(i) for i in range(self.first, last)]
+        self.listbox.delete(0, tk.END)
+        if rows:
+            self.listbox.insert(tk.END, *rows)
+        if self.selected is not None and self.first <= self.selected < last:
+            self.listbox.selection_set(self.selected - self.first)
+        self._update_scrollbar()
+
+    def scroll_to(self, first):
+        """滚动到以first为第一行的位置"""
+        first = max(0, min(int(first), self.count - self.height))
+        if first != self.first:
+            self.first = first
+            self.refresh()
+
+    def see(self, index):
+        """滚动使指定行可见"""
+        if index < self.first:
+            self.scroll_to(index)
+        elif index >= self.first + self.height:
+            self.scroll_to(index - self.height + 1)
+
+    def select(self, index):
+        """选中指定行并滚动到可见位置（不触发on_select）"""
+        if not 0 <= index < self.count:
+            return
+        self.selected = index
+        self.listbox.selection_clear(0, tk.END)
+        if self.first <= index < self.first + self.height:
+            self.listbox.selection_set(index - self.first)
+        else:
+            self.see(index)
+
+    def yview(self, *args):
+        """滚动条回调"""
+        if not args:
+            return
+        if args[0] == 'moveto':
+            self.scroll_to(float(args[1]) * self.count)
+        elif args[0] == 'scroll':
+            step = int(args[1])
+            if args[2] == 'pages':
+                step *= self.height
+            self.scroll_to(self.first + step)
+
+    def _update_scrollbar(self):
+        """按总行数更新滚动条位置"""
+        if self.count <= self.height:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(self.first / self.count, (self.first + self.height) / self.count)
+
+    def _on_listbox_select(self, event):
+        """Listbox选择事件，换算为全局行索引"""
+        selection = self.listbox.curselection()
+        if selection:
+            self.selected = self.first + selection[0]
+            if self.on_select:
+                self.on_select(self.selected)
+
+    def _on_mousewheel(self, event):
+        """鼠标滚轮滚动"""
+        if event.num == 4:
+            step = -1
+        elif event.num == 5:
+            step = 1
+        else:
+            step = -1 if event.delta > 0 else 1
+        self.scroll_to(self.first + step)
+        return "break"
+
+    def _move_selection(self, step):
+        """键盘移动选中行"""
+        if not self.count:
+            return "break"
+        current = self.selected if self.selected is not None else self.first
+        index = max(0, min(self.count - 1, current + step))
+        self.select(index)
+        if self.on_select:
+            self.on_select(index)
+        return "break"
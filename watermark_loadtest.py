@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+水印服务压力测试 - 用多个长连接并发上传图片，统计吞吐量和延迟分位数（p50/p90/p99）
+
+用法：
+    python watermark_cli.py serve --port 8080 &
+    python watermark_loadtest.py --image photo.jpg --template 红-中 -c 16 -n 500
+
+503（服务繁忙）的请求单独统计，不计入延迟；收到503的连接等待--backoff秒后再发送下一个请求。结果以JSON输出（-o指定文件）。
+"""
+
+import io
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit, urlencode
+
+import watermark_bench
+
+
+def percentile(values, fraction):
+    """最近秩法分位数，values需已排序"""
+    if not values:
+        return None
+    rank = max(1, math.ceil(fraction * len(values)))
+    return values[rank - 1]
+
+
+class Client:
+    """一个HTTP/1.1长连接；服务端关闭连接后自动重连"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, path, body, headers=None):
+        """发送POST请求，返回(状态码, 响应体)"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f"POST {path} HTTP/1.1", f"Host: {self.host}", f"Content-Length: {len(body)}"]
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('utf-8') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("服务端关闭了连接")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        data = await self.reader.readexactly(int(response_headers.get('content-length', 0)))
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, data
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+async def run_load(url, body, headers, concurrency, requests, warmup=0, backoff=0.1):
+    """并发发送请求，返回统计结果"""
+    parts = urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    latencies = []
+    statuses = {}
+    errors = []
+    counter = iter(range(requests + warmup))
+    output_bytes = 0
+
+    async def worker():
+        nonlocal output_bytes
+        client = Client(parts.hostname, parts.port or 80)
+        try:
+            for index in counter:
+                start = time.perf_counter()
+                try:
+                    status, data = await client.request(path, body, headers)
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    client.close()
+                    errors.append(str(e))
+                    continue
+                if status == 503:
+                    await asyncio.sleep(backoff)
+                if index < warmup:
+                    continue
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                    output_bytes += len(data)
+        finally:
+            client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'errors': len(errors),
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 0.50)),
+            'p90': ms(percentile(latencies, 0.90)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'output_mb': round(output_bytes / 1e6, 2),
+    }
+
+
+def build_parser():
+    """构建命令行参数解析器"""
+    parser = argparse.ArgumentParser(description="照片水印工具 - HTTP服务压力测试")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/watermark", help="服务地址")
+    parser.add_argument("--image", help="上传的图片（默认生成一张合成图片）")
+    parser.add_argument("--megapixels", type=float, default=2, help="合成图片的尺寸（百万像素，默认2）")
+    parser.add_argument("--template", help="模板名称")
+    parser.add_argument("--config", help="内联水印配置（JSON，通过X-Watermark-Config发送）")
+    parser.add_argument("--format", help="输出格式（jpeg/png/webp/tiff）")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="并发连接数（默认8）")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="请求总数（默认200）")
+    parser.add_argument("--backoff", type=float, default=0.1, help="收到503后等待的时间（秒，默认0.1）")
+    parser.add_argument("--warmup", type=int, default=None, help="预热请求数，不计入统计（默认等于并发数）")
+    parser.add_argument("-o", "--output", help="结果JSON文件（默认输出到stdout）")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.image:
+        with open(args.image, 'rb') as f:
+            body = f.read()
+    else:
+        # 与基准测试相同的确定性合成图片
+        side = int((args.megapixels * 1e6) ** 0.5)
+        img = watermark_bench._synthetic_image(side * 4 // 3, side * 3 // 4, alpha=False)
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=90)
+        body = buffer.getvalue()
+
+    query = {key: value for key, value in (('template', args.template), ('format', args.format)) if value}
+    url = args.url + ("?" + urlencode(query) if query else "")
+    headers = {'X-Watermark-Config': args.config} if args.config else {}
+    warmup = args.concurrency if args.warmup is None else args.warmup
+
+    print(f"压力测试 {url}: {len(body) / 1e6:.2f} MB/请求, 并发 {args.concurrency}, {args.requests} 个请求",
+          file=sys.stderr)
+    result = asyncio.run(run_load(url, body, headers, args.concurrency, args.requests, warmup, args.backoff))
+    latency = result['latency_ms']
+    print(f"{result['requests_per_sec']} 请求/秒, p50 {latency['p50']} ms, p90 {latency['p90']} ms, "
+          f"p99 {latency['p99']} ms, 状态 {result['statuses']}, 连接错误 {result['errors']}", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    return 0 if result['errors'] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
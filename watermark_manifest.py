@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+导出清单 - 记录每个输出文件对应的原图指纹和水印配置，再次导出时跳过未变化的图片
+
+导出过程中每完成一张图片就向日志文件追加一行，程序崩溃或断电后重新导出时先重放日志，
+已完成的图片不会重新处理。
+"""
+
+import os
+import json
+import time
+import hashlib
+
+import watermark_engine
+
+# 清单文件名（保存在输出文件夹中）
+MANIFEST_FILENAME = ".watermark_manifest.json"
+MANIFEST_VERSION = 1
+# 导出日志文件名（导出进行中或被中断时存在）
+JOURNAL_FILENAME = ".watermark_journal.jsonl"
+# 每记录多少张图片把日志同步到磁盘（断电时最多重新导出这么多张）
+JOURNAL_SYNC_EVERY = 32
+
+
+def file_content_hash(path, chunk_size=1024 * 1024):
+    """计算文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint(path, content_hash=False):
+    """原图指纹：文件大小和修改时间，可选内容哈希"""
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if content_hash:
+        fingerprint['sha256'] = file_content_hash(path)
+    return fingerprint
+
+
+def config_hash(config, **settings):
+    """水印配置和导出设置的哈希，渲染算法版本变化时也会改变"""
+    payload = {
+        'render_version': watermark_engine.RENDER_VERSION,
+        'config': config,
+        'settings': settings,
+    }
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=list)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def output_config_hash(config, settings, output_path):
+    """某个输出文件的配置哈希：水印配置和该输出格式使用的导出设置"""
+    ext = os.path.splitext(output_path)[1]
+    return config_hash(config, **watermark_engine.settings_signature(settings, ext))
+
+
+def interrupted_run(output_folder):
+    """输出文件夹中上次被中断的导出信息（begin_run()记录的内容），没有中断的导出时返回None"""
+    try:
+        with open(os.path.join(output_folder, JOURNAL_FILENAME), 'r', encoding='utf-8') as f:
+            first_line = f.readline()
+    except OSError:
+        return None
+    try:
+        return json.loads(first_line).get('run') or {}
+    except (ValueError, AttributeError):
+        return {}
+
+
+class ExportManifest:
+    """输出文件夹中的导出清单
+
+    每个输出文件记录原图路径、原图指纹和配置哈希。原图大小和修改时间都未变化时
+    直接视为未变化；启用content_hash时，即使修改时间变了，只要内容哈希相同也视为未变化。
+
+    begin_run()之后record()同时追加到日志文件，save()写入完整清单后清空日志，
+    finish()在导出正常结束后删除日志。打开时如果存在日志（上次导出被中断），
+    先把日志中的记录合并到清单，interrupted为上次导出开始时记录的信息。
+    """
+
+    def __init__(self, output_folder, content_hash=False):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, MANIFEST_FILENAME)
+        self.journal_path = os.path.join(output_folder, JOURNAL_FILENAME)
+        self.content_hash = content_hash
+        self.entries = {}
+        self.interrupted = None
+        self._dirty = 0
+        self._journal = None
+        self._journal_header = None
+        self._unsynced = 0
+        self.load()
+        self._replay_journal()
+
+    def load(self):
+        """读取清单，文件不存在或损坏时从空清单开始"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data.get('outputs', {})
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _replay_journal(self):
+        """合并上次被中断的导出日志，最后一行可能只写了一半，直接忽略"""
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'run' in record:
+                self.interrupted = record['run']
+            elif 'output' in record:
+                self.entries[record['output']] = record['entry']
+                self._dirty += 1
+        if self.interrupted is None:
+            self.interrupted = {}
+
+    def save(self):
+        """写入清单（先写临时文件再替换，避免写到一半的清单），之后清空导出日志"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'outputs': self.entries}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._dirty = 0
+        if self._journal is not None:
+            self._journal.close()
+            self._open_journal('w')
+
+    def begin_run(self, resume=False, **info):
+        """开始导出：创建导出日志，info（导出设置等）记录在日志开头，恢复导出时可以读取
+
+        resume为True时继续被中断的导出，保留原来的日志开头；否则记录本次的info。
+        """
+        if self._journal is not None:
+            return
+        if resume and self.interrupted:
+            self._journal_header = self.interrupted
+        else:
+            self._journal_header = dict(info, started=time.time())
+        if self.interrupted is not None:
+            # 合并后的记录写入清单，日志从头开始
+            self.save()
+        self._open_journal('w')
+
+    def _open_journal(self, mode):
+        self._journal = open(self.journal_path, mode, encoding='utf-8')
+        self._journal.write(json.dumps({'run': self._journal_header}, ensure_ascii=False) + "\n")
+        self._sync_journal()
+
+    def _sync_journal(self):
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._unsynced = 0
+
+    def finish(self):
+        """导出正常结束：写入清单并删除导出日志"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.save()
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+        self.interrupted = None
+
+    def close(self):
+        """导出被取消或出错：写入清单，保留导出日志以便恢复"""
+        self.save()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def is_up_to_date(self, img_path, output_path, cfg_hash):
+        """输出文件是否存在且与当前原图和配置一致"""
+        entry = self.entries.get(os.path.basename(output_path))
+        if entry is None or entry.get('config_hash') != cfg_hash:
+            return False
+        if entry.get('source') != os.path.abspath(img_path) or not os.path.exists(output_path):
+            return False
+
+        try:
+            fingerprint = source_fingerprint(img_path)
+        except OSError:
+            return False
+        if fingerprint['size'] != entry.get('size'):
+            return False
+        if fingerprint['mtime_ns'] == entry.get('mtime_ns'):
+            return True
+
+        # 修改时间变化但大小相同：比较内容哈希
+        if self.content_hash and entry.get('sha256'):
+            try:
+                if file_content_hash(img_path) != entry['sha256']:
+                    return False
+            except OSError:
+                return False
+            # 内容未变，更新修改时间，下次无需再计算哈希
+            entry['mtime_ns'] = fingerprint['mtime_ns']
+            self._dirty += 1
+            return True
+        return False
+
+    def record(self, img_path, output_path, cfg_hash, fingerprint=None, autosave_every=500):
+        """记录一个已完成的输出；fingerprint应在导出前获取，导出过程中原图被修改时下次会重新导出"""
+        if fingerprint is None:
+            fingerprint = source_fingerprint(img_path, self.content_hash)
+        entry = {'source': os.path.abspath(img_path), 'config_hash': cfg_hash}
+        entry.update(fingerprint)
+        output = os.path.basename(output_path)
+        self.entries[output] = entry
+        self._dirty += 1
+        if self._journal is not None:
+            self._journal.write(json.dumps({'output': output, 'entry': entry}, ensure_ascii=False) + "\n")
+            # 每行都写出到系统缓冲区（程序崩溃时不丢失），每JOURNAL_SYNC_EVERY行同步到磁盘
+            self._journal.flush()
+            self._unsynced += 1
+            if self._unsynced >= JOURNAL_SYNC_EVERY:
+                self._sync_journal()
+        if autosave_every and self._dirty >= autosave_every:
+            self.save()
+
+    def plan(self, items, force=False, settings=None):
+        """筛选需要导出的图片
+
+        items为[(原图路径, 配置), ...]，settings为导出设置（输出格式、质量等）。
+        返回(待导出列表[(原图路径, 配置, 配置哈希, 原图指纹)], 跳过数量)。
+        """
+        settings = settings or watermark_engine.DEFAULT_EXPORT_SETTINGS
+        # 多张图片共享同一个配置对象时，每种输出格式只计算一次哈希（保存配置的引用，保证id不被复用）
+        hashes = {}
+        pending = []
+        skipped = 0
+        for img_path, config in items:
+            output_path = watermark_engine.output_path_for(img_path, self.output_folder,
+                                                           output_format=settings['format'])
+            key = (id(config), os.path.splitext(output_path)[1].lower())
+            cached = hashes.get(key)
+            if cached is None:
+                cached = hashes[key] = (config, output_config_hash(config, settings, output_path))
+            cfg_hash = cached[1]
+            if not force and self.is_up_to_date(img_path, output_path, cfg_hash):
+                skipped += 1
+                continue
+            try:
+                fingerprint = source_fingerprint(img_path, self.content_hash)
+            except OSError:
+                fingerprint = None
+            pending.append((img_path, config, cfg_hash, fingerprint))
+        return pending, skipped
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流水线导出 - 读取、解码/合成/编码、写入三个阶段并行进行，阶段之间用有界队列限制内存
+"""
+
+import os
+import time
+import uuid
+import queue
+import threading
+
+from PIL import UnidentifiedImageError
+
+import watermark_engine
+import watermark_trace
+
+# 队列结束标记
+_DONE = object()
+# 写入中的临时文件后缀，写完后改名为输出文件名
+PARTIAL_SUFFIX = ".wmpart"
+
+
+def write_atomic(path, data, fsync=False):
+    """先写入临时文件再改名，输出文件要么不存在，要么是完整的
+
+    fsync为True时改名前把数据同步到磁盘，断电后也不会出现内容不完整的输出文件。
+    临时文件名带随机部分，多个进程同时写入同一输出时互不干扰。
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}{PARTIAL_SUFFIX}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def remove_partial_outputs(output_folder, older_than=None):
+    """删除上次导出中断时留下的临时文件，返回删除的数量
+
+    older_than（秒）指定时只删除修改时间早于该时长的临时文件（其他进程可能仍在写入）。
+    """
+    removed = 0
+    now = time.time()
+    try:
+        names = os.listdir(output_folder)
+    except OSError:
+        return 0
+    for name in names:
+        if name.endswith(PARTIAL_SUFFIX):
+            path = os.path.join(output_folder, name)
+            try:
+                if older_than is not None and now - os.stat(path).st_mtime < older_than:
+                    continue
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+class ExportPipeline:
+    """三段式导出流水线
+
+    读取阶段（I/O线程）把原图文件读入内存，CPU阶段解码、添加水印并编码，
+    写入阶段（I/O线程）把结果写到输出文件夹。磁盘读写与图像计算同时进行，
+    阶段之间的有界队列限制同时在内存中的图片数量。
+
+    CPU阶段默认在线程中运行（Pillow解码、合成、编码时会释放GIL）；传入cpu_executor
+    （如ProcessPoolExecutor）时，CPU阶段的每个线程把工作提交给该执行器并等待结果。
+
+    输出文件先写入临时文件再改名（见write_atomic()）；fsync为True时改名前同步到磁盘。
+    """
+
+    def __init__(self, output_folder, settings=None, read_workers=2, cpu_workers=None,
+                 write_workers=2, queue_size=None, cpu_executor=None, fsync=False):
+        self.output_folder = output_folder
+        self.settings = settings or watermark_engine.DEFAULT_EXPORT_SETTINGS
+        self.read_workers = read_workers
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
+        self.write_workers = write_workers
+        self.queue_size = queue_size or self.cpu_workers * 2
+        self.cpu_executor = cpu_executor
+        self.fsync = fsync
+
+    def run(self, tasks, on_done=None, cancel_event=None):
+        """执行导出，阻塞直到全部完成
+
+        tasks为可迭代的(原图路径, 水印配置, 附加数据)；每张图片完成后在调用线程中
+        调用on_done(附加数据, 原图路径, 输出路径或None, 错误信息或None)。
+        cancel_event被设置后不再开始新的图片，已读入但未处理的图片直接丢弃。
+        返回(成功数量, 失败数量)。
+        """
+        cancel_event = cancel_event or threading.Event()
+        queues = [queue.Queue(self.queue_size) for _ in range(3)]
+        results = queue.Queue()
+        stages = [
+            (self.read_workers, self._read),
+            (self.cpu_workers, self._encode),
+            (self.write_workers, self._write),
+        ]
+
+        # 每个阶段：从queues[i]取出，处理后放入queues[i + 1]，最后一个阶段把结果放入results
+        threads = []
+        for index, (workers, fn) in enumerate(stages):
+            out_q = queues[index + 1] if index + 1 < len(queues) else None
+            threads.append([
+                threading.Thread(target=self._stage_worker,
+                                 args=(fn, queues[index], out_q, results, cancel_event),
+                                 name=f"pipeline{fn.__name__}", daemon=True)
+                for _ in range(workers)
+            ])
+        for stage_threads in threads:
+            for thread in stage_threads:
+                thread.start()
+
+        threading.Thread(target=self._feed, args=(tasks, queues[0], cancel_event, results),
+                         name="pipeline-feed", daemon=True).start()
+        threading.Thread(target=self._close_stages, args=(threads, queues, results),
+                         name="pipeline-close", daemon=True).start()
+
+        succeeded = failed = 0
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            token, img_path, output_path, error = result
+            if error is None:
+                succeeded += 1
+            else:
+                failed += 1
+            if on_done:
+                on_done(token, img_path, output_path, error)
+        return succeeded, failed
+
+    @staticmethod
+    def _feed(tasks, read_q, cancel_event, results):
+        """遍历任务放入读取队列（队列满时阻塞），结束后放入结束标记"""
+        try:
+            for img_path, config, token in tasks:
+                if cancel_event.is_set():
+                    break
+                read_q.put((img_path, token, config, None))
+        except Exception as e:
+            results.put((None, None, None, f"读取任务列表失败: {e}"))
+        finally:
+            read_q.put(_DONE)
+
+    @staticmethod
+    def _close_stages(threads, queues, results):
+        """某阶段收到结束标记的线程把标记传回队列，全部结束后通知下一阶段"""
+        for index, stage_threads in enumerate(threads):
+            for thread in stage_threads:
+                thread.join()
+            if index + 1 < len(queues):
+                queues[index + 1].put(_DONE)
+        results.put(_DONE)
+
+    @staticmethod
+    def _stage_worker(fn, in_q, out_q, results, cancel_event):
+        """阶段工作线程；出错的图片直接报告失败，不再进入后续阶段"""
+        while True:
+            item = in_q.get()
+            if item is _DONE:
+                # 放回结束标记，让同阶段的其他线程也能退出
+                in_q.put(_DONE)
+                return
+            if cancel_event.is_set():
+                continue
+            img_path, token = item[0], item[1]
+            try:
+                output = fn(item)
+            except Exception as e:
+                results.put((token, img_path, None, str(e)))
+                continue
+            if out_q is not None:
+                out_q.put(output)
+            else:
+                results.put((token, img_path, output, None))
+
+    def _read(self, item):
+        """读取原图文件内容"""
+        img_path, token, config, _ = item
+        with watermark_trace.span("read"), open(img_path, 'rb') as f:
+            return img_path, token, config, f.read()
+
+    def _encode(self, item):
+        """解码、添加水印并编码为输出格式"""
+        img_path, token, config, data = item
+        ext = os.path.splitext(self._output_path(img_path))[1]
+        try:
+            if self.cpu_executor is not None:
+                encoded = self.cpu_executor.submit(watermark_engine.encode_watermarked,
+                                                   data, config, ext, self.settings).result()
+            else:
+                encoded = watermark_engine.encode_watermarked(data, config, ext, self.settings)
+        except UnidentifiedImageError:
+            # 与直接打开文件时Pillow的信息相同，指明是哪个原图
+            raise UnidentifiedImageError(f"cannot identify image file {img_path!r}") from None
+        return img_path, token, config, encoded
+
+    def _write(self, item):
+        """写入输出文件，返回输出路径"""
+        img_path, token, config, encoded = item
+        output_path = self._output_path(img_path)
+        with watermark_trace.span("write", bytes=len(encoded)):
+            write_atomic(output_path, encoded, self.fsync)
+        return output_path
+
+    def _output_path(self, img_path):
+        """输出文件路径（扩展名由输出格式决定）"""
+        return watermark_engine.output_path_for(img_path, self.output_folder,
+                                                output_format=self.settings['format'])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+预览预读 - 在后台线程中提前解码相邻图片并生成预览代理图，切换图片时无需等待
+"""
+
+import queue
+import threading
+from collections import OrderedDict
+
+import watermark_engine
+
+# 预读缓存占用内存的上限（字节），PNG等格式按原尺寸解码，每张可能占用上百MB
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class PreviewEntry:
+    """预读好的一张图片"""
+
+    __slots__ = ('path', 'image', 'full_size', 'proxy', 'proxy_scale', 'preview_size', 'nbytes')
+
+    def __init__(self, path, image, full_size, proxy, proxy_scale, preview_size):
+        self.path = path
+        self.image = image
+        self.full_size = full_size
+        self.proxy = proxy
+        self.proxy_scale = proxy_scale
+        self.preview_size = preview_size
+        # 解码图片和代理图占用的内存（代理图可能就是解码图片本身）
+        self.nbytes = _image_bytes(image) + (_image_bytes(proxy) if proxy is not image else 0)
+
+
+def _image_bytes(img):
+    """图片像素数据大约占用的字节数"""
+    return img.width * img.height * len(img.getbands())
+
+
+def load_preview_entry(path, max_width, max_height):
+    """解码图片（JPEG按预览尺寸缩小解码）并生成预览代理图"""
+    image, full_size = watermark_engine.open_for_preview(path, max_width, max_height)
+    proxy, proxy_scale = watermark_engine.make_preview(image, max_width, max_height, full_size)
+    return PreviewEntry(path, image, full_size, proxy, proxy_scale, (max_width, max_height))
+
+
+class PreviewPrefetcher:
+    """相邻图片预读器
+
+    每次切换图片时调用prefetch()，工作线程按距离由近到远解码当前图片前后radius张，
+    结果放入LRU缓存，缓存同时受项数（max_entries）和占用内存（max_bytes）限制，
+    单张超过max_bytes的图片不缓存。再次调用prefetch()时，尚未开始的旧任务
+    会被丢弃，因此在列表中快速跳转不会堆积过期的解码工作。
+    """
+
+    def __init__(self, radius=2, max_entries=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.radius = radius
+        self.max_entries = max_entries or radius * 2 + 3
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tasks = queue.Queue()
+        self._generation = 0
+        self._thread = threading.Thread(target=self._run, name="preview-prefetch", daemon=True)
+        self._thread.start()
+
+    def get(self, path):
+        """返回已预读的图片，没有时返回None"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+            return entry
+
+    def load(self, path, max_width, max_height):
+        """同步加载图片（缓存未命中时使用），结果同样放入缓存"""
+        entry = load_preview_entry(path, max_width, max_height)
+        self._store(entry)
+        return entry
+
+    def prefetch(self, paths, center_index, max_width, max_height):
+        """预读center_index前后的图片，取消之前尚未开始的预读任务"""
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+
+        # 清空旧任务
+        try:
+            while True:
+                self._tasks.get_nowait()
+        except queue.Empty:
+            pass
+
+        # 下一张优先，然后上一张，依次向外
+        for distance in range(1, self.radius + 1):
+            for index in (center_index + distance, center_index - distance):
+                if 0 <= index < len(paths):
+                    self._tasks.put((generation, paths[index], max_width, max_height))
+
+    def cancel(self):
+        """取消所有尚未开始的预读任务"""
+        with self._lock:
+            self._generation += 1
+
+    def clear(self):
+        """取消预读并清空缓存"""
+        self.cancel()
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _store(self, entry):
+        """放入缓存，超出项数或内存上限时淘汰最久未使用的图片"""
+        if entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(entry.path, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes
+            self._entries[entry.path] = entry
+            self.current_bytes += entry.nbytes
+            while len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    def _run(self):
+        """工作线程主循环"""
+        while True:
+            generation, path, max_width, max_height = self._tasks.get()
+            with self._lock:
+                if generation != self._generation:
+                    continue
+                entry = self._entries.get(path)
+                if entry is not None and entry.preview_size == (max_width, max_height):
+                    continue
+            try:
+                entry = load_preview_entry(path, max_width, max_height)
+            except Exception:
+                # 无法解码的图片在真正切换到它时再报告错误
+                continue
+            self._store(entry)
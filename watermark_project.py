@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+项目文件 - 用SQLite保存图片列表、文件头信息和每张图片的水印配置
+
+打开项目时只读取行数，图片路径按页在显示时读取；修改水印配置时只写入对应的一行，
+不重写整个文件。未保存的项目使用内存数据库，另存为时整体复制到文件。
+"""
+
+import json
+import sqlite3
+from collections import OrderedDict
+from collections.abc import Sequence
+
+import watermark_configs
+import watermark_scan
+
+# 项目文件扩展名
+PROJECT_SUFFIX = ".wmproj"
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    idx INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    mode TEXT
+);
+CREATE TABLE IF NOT EXISTS configs (
+    path TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL,
+    base TEXT,
+    overrides TEXT
+);
+"""
+
+
+def _dumps(config):
+    return json.dumps(config, ensure_ascii=False, sort_keys=True)
+
+
+def _loads(data):
+    """读取JSON保存的配置，颜色和位置恢复为元组"""
+    config = json.loads(data)
+    for key in ('font_color', 'position'):
+        if isinstance(config.get(key), list):
+            config[key] = tuple(config[key])
+    return config
+
+
+class ProjectImageList(Sequence):
+    """项目中的图片列表
+
+    按索引访问时整页（PAGE_SIZE行）读取并缓存最近使用的页，总行数保存在内存中，
+    打开项目时不读取任何路径。追加的图片立即写入数据库。
+    """
+
+    PAGE_SIZE = 256
+    MAX_PAGES = 64
+
+    def __init__(self, project):
+        self.project = project
+        self._pages = OrderedDict()
+        row = project.conn.execute("SELECT MAX(idx) FROM images").fetchone()
+        self._count = 0 if row[0] is None else row[0] + 1
+
+    def __len__(self):
+        return self._count
+
+    def _page(self, page_index):
+        """读取一页（路径和文件头信息）"""
+        page = self._pages.get(page_index)
+        if page is not None:
+            self._pages.move_to_end(page_index)
+            return page
+        start = page_index * self.PAGE_SIZE
+        page = self.project.conn.execute(
+            "SELECT path, width, height, format, mode FROM images WHERE idx >= ? AND idx < ? ORDER BY idx",
+            (start, start + self.PAGE_SIZE)).fetchall()
+        self._pages[page_index] = page
+        while len(self._pages) > self.MAX_PAGES:
+            self._pages.popitem(last=False)
+        return page
+
+    def _row(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("图片索引超出范围")
+        return self._page(index // self.PAGE_SIZE)[index % self.PAGE_SIZE]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        return self._row(index)[0]
+
+    def __iter__(self):
+        # 顺序遍历时逐页读取，不占用页缓存
+        for start in range(0, self._count, self.PAGE_SIZE):
+            rows = self.project.conn.execute(
+                "SELECT path FROM images WHERE idx >= ? AND idx < ? ORDER BY idx",
+                (start, start + self.PAGE_SIZE)).fetchall()
+            for (path,) in rows:
+                yield path
+
+    def info(self, index):
+        """导入时探测到的文件头信息，未探测时返回None"""
+        path, width, height, image_format, mode = self._row(index)
+        if width is None:
+            return None
+        return watermark_scan.ImageInfo(path, width, height, image_format, mode)
+
+    def append(self, item):
+        """追加一张图片（路径或ImageInfo）"""
+        self.extend([item])
+
+    def extend(self, items):
+        """追加多张图片（路径或ImageInfo）"""
+        rows = []
+        for item in items:
+            if isinstance(item, watermark_scan.ImageInfo):
+                rows.append((self._count + len(rows), item.path, item.width, item.height, item.format, item.mode))
+            else:
+                rows.append((self._count + len(rows), item, None, None, None, None))
+        if not rows:
+            return
+        self.project.conn.executemany("INSERT INTO images VALUES (?, ?, ?, ?, ?, ?)", rows)
+        # 最后一页可能已缓存了不完整的内容
+        for page_index in range(self._count // self.PAGE_SIZE, (self._count + len(rows) - 1) // self.PAGE_SIZE + 1):
+            self._pages.pop(page_index, None)
+        self._count += len(rows)
+        self.project.mark_dirty()
+
+
+class ProjectConfigStore(watermark_configs.ConfigStore):
+    """保存在项目中的水印配置
+
+    单独设置在第一次访问某张图片时从数据库读取，修改时只写入该图片的一行；
+    批量应用模板只更新公共模板和代数，旧的单独设置在读取时按代数忽略。
+    """
+
+    def __init__(self, project, default_config):
+        super().__init__(default_config)
+        self.project = project
+        self._loaded = set()
+        base = project.get_meta('base')
+        if base is not None:
+            self._base = watermark_configs.freeze(_loads(base))
+        self._generation = int(project.get_meta('generation', 0))
+
+    def _entry(self, path):
+        if path not in self._loaded:
+            self._loaded.add(path)
+            row = self.project.conn.execute(
+                "SELECT base, overrides FROM configs WHERE path = ? AND generation = ?",
+                (path, self._generation)).fetchone()
+            if row is not None:
+                self._entries[path] = self._entry_from_row(*row)
+        return super()._entry(path)
+
+    def _entry_from_row(self, base, overrides):
+        base = self._base if base is None else watermark_configs.freeze(_loads(base))
+        overrides = _loads(overrides) if overrides else None
+        return watermark_configs.ImageConfigEntry(self._generation, base, overrides)
+
+    def preload(self):
+        """一次读取所有有效的单独设置（导出前使用，避免逐张查询）"""
+        rows = self.project.conn.execute(
+            "SELECT path, base, overrides FROM configs WHERE generation = ?", (self._generation,))
+        for path, base, overrides in rows:
+            if path not in self._loaded:
+                self._loaded.add(path)
+                self._entries[path] = self._entry_from_row(base, overrides)
+        self._loaded = _AllLoaded()
+
+    def overridden(self):
+        self.preload()
+        return super().overridden()
+
+    def _write(self, path):
+        entry = self._entries.get(path)
+        if entry is None:
+            self.project.conn.execute("DELETE FROM configs WHERE path = ?", (path,))
+        else:
+            base = None if entry.base is self._base else _dumps(entry.base)
+            overrides = _dumps(entry.overrides) if entry.overrides else None
+            self.project.conn.execute("INSERT OR REPLACE INTO configs VALUES (?, ?, ?, ?)",
+                                      (path, entry.generation, base, overrides))
+        self.project.mark_dirty()
+
+    def set(self, path, config):
+        super().set(path, config)
+        self._write(path)
+
+    def apply(self, path, template):
+        self._loaded.add(path)
+        super().apply(path, template)
+        self._write(path)
+
+    def reset(self, path):
+        self._loaded.add(path)
+        super().reset(path)
+        self._write(path)
+
+    def apply_to_all(self, template):
+        super().apply_to_all(template)
+        self._loaded = set()
+        self.project.set_meta('base', _dumps(self._base))
+        self.project.set_meta('generation', self._generation)
+
+
+class _AllLoaded:
+    """preload()之后所有图片都视为已读取"""
+
+    def __contains__(self, path):
+        return True
+
+    def add(self, path):
+        pass
+
+
+class Project:
+    """水印项目
+
+    path为None时使用内存数据库（未保存的项目）。修改先写入当前事务，
+    由commit()提交，界面在操作间隙定期调用。
+    """
+
+    def __init__(self, path=None, default_config=None):
+        self.path = path
+        self.conn = self._connect(path or ":memory:")
+        self._dirty = False
+        version = self.get_meta('version')
+        if version is None:
+            self.set_meta('version', SCHEMA_VERSION)
+            self.conn.commit()
+        elif int(version) > SCHEMA_VERSION:
+            raise ValueError(f"项目文件版本 {version} 过新，请升级程序")
+        self.images = ProjectImageList(self)
+        self.configs = ProjectConfigStore(self, default_config or {})
+
+    @staticmethod
+    def _connect(path):
+        conn = sqlite3.connect(path)
+        if path != ":memory:":
+            # WAL模式下逐行写入无需每次重写数据库，断电后也只会丢失最后一次提交之后的修改
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    @property
+    def is_saved(self):
+        """是否已保存为文件"""
+        return self.path is not None
+
+    @property
+    def dirty(self):
+        """是否有未提交的修改"""
+        return self._dirty
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+        self._dirty = True
+
+    def commit(self):
+        """提交未保存的修改"""
+        if self._dirty:
+            self.conn.commit()
+            self._dirty = False
+
+    def save_as(self, path):
+        """把项目整体复制到新文件，之后的修改写入该文件"""
+        self.conn.commit()
+        target = self._connect(path)
+        self.conn.backup(target)
+        self.conn.close()
+        target.execute("PRAGMA journal_mode=WAL")
+        self.conn = target
+        self.path = path
+        self._dirty = False
+
+    def close(self):
+        """提交修改，清理已失效的单独设置并关闭"""
+        self.conn.execute("DELETE FROM configs WHERE generation != ?", (self.configs._generation,))
+        self.conn.commit()
+        self.conn.close()
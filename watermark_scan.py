@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文件夹扫描 - 用os.scandir流式列出图片，只读取文件头获取尺寸和格式
+"""
+
+import os
+import time
+import queue
+import threading
+from PIL import Image
+
+import watermark_engine
+
+
+class ImageInfo:
+    """只读取文件头得到的图片信息"""
+
+    __slots__ = ('path', 'width', 'height', 'format', 'mode')
+
+    def __init__(self, path, width, height, format, mode):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.format = format
+        self.mode = mode
+
+
+def iter_image_files(folder, recursive=True, extensions=watermark_engine.SUPPORTED_FORMATS):
+    """用os.scandir逐个目录列出图片文件，边扫描边返回
+
+    同一目录内的文件按scandir返回的顺序（不排序，大目录也能立即返回第一张），
+    需要固定顺序的调用方自行排序；目录的文件列完后按名称顺序扫描子目录。
+    """
+    pending = [folder]
+    while pending:
+        current = pending.pop()
+        subdirs = []
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.name.lower().endswith(extensions) and entry.is_file():
+                            yield entry.path
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+        if recursive:
+            # 倒序压栈，保证子目录按名称顺序扫描
+            pending.extend(sorted(subdirs, reverse=True))
+
+
+def probe_image(path):
+    """只解析文件头获取尺寸、格式和模式，不解码像素"""
+    with Image.open(path) as img:
+        return ImageInfo(path, img.width, img.height, img.format, img.mode)
+
+
+class FolderScanner:
+    """后台文件夹扫描器
+
+    在工作线程中扫描并探测图片，把结果按批放入results队列（每项为ImageInfo列表），
+    扫描结束后放入None。无法识别的文件计入skipped并跳过。
+    文件按扫描到的顺序返回，只在每批之内按路径排序（批的大小有上限，不等待整个目录列完）。
+    """
+
+    def __init__(self, folder, recursive=True, batch_size=200, batch_interval=0.1):
+        self.folder = folder
+        self.recursive = recursive
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.results = queue.Queue()
+        self.found = 0
+        self.skipped = 0
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="folder-scan", daemon=True)
+
+    def start(self):
+        """开始扫描"""
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """停止扫描"""
+        self._cancelled.set()
+
+    def is_alive(self):
+        """扫描是否仍在进行"""
+        return self._thread.is_alive()
+
+    def _run(self):
+        """工作线程主循环"""
+        batch = []
+        last_flush = time.monotonic()
+        try:
+            for path in iter_image_files(self.folder, self.recursive):
+                if self._cancelled.is_set():
+                    break
+                try:
+                    batch.append(probe_image(path))
+                    self.found += 1
+                except Exception:
+                    self.skipped += 1
+                    continue
+
+                if len(batch) >= self.batch_size or time.monotonic() - last_flush >= self.batch_interval:
+                    self._put_batch(batch)
+                    batch = []
+                    last_flush = time.monotonic()
+        finally:
+            if batch:
+                self._put_batch(batch)
+            self.results.put(None)
+
+    def _put_batch(self, batch):
+        batch.sort(key=lambda info: info.path)
+        self.results.put(batch)
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地HTTP水印服务 - asyncio处理连接，解码、添加水印和编码在常驻的进程池（或线程池）中进行
+
+接口：
+  POST /watermark?template=模板名称   请求体为原图，返回添加水印后的图片
+       水印配置也可以用请求头X-Watermark-Config（JSON，未指定的字段使用默认值）直接给出；
+       可选参数format（jpeg/png/webp/tiff，默认与原图相同）、preset、quality
+  GET  /health                        服务状态（正在处理、排队、已完成的请求数）
+
+工作进程常驻，字体和水印图块缓存在请求之间保留；同时处理的请求数和排队的请求数都有上限，
+超出时立即返回503，客户端稍后重试。
+"""
+
+import os
+import json
+import time
+import signal
+import asyncio
+import multiprocessing
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+import watermark_configs
+import watermark_engine
+
+# 默认最大请求体（字节）
+DEFAULT_MAX_BODY = 100 * 1024 * 1024
+# 读取请求头的超时（秒），空闲的长连接超过该时间后关闭
+HEADER_TIMEOUT = 30
+
+# 文件头特征 -> 扩展名
+_MAGIC = (
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'BM', '.bmp'),
+    (b'II*\x00', '.tiff'),
+    (b'MM\x00*', '.tiff'),
+)
+_CONTENT_TYPES = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+    '.bmp': 'image/bmp', '.tiff': 'image/tiff', '.webp': 'image/webp',
+}
+_REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    411: 'Length Required', 413: 'Payload Too Large', 500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class RequestError(Exception):
+    """返回给客户端的错误（状态码和信息）；body_read表示请求体是否已读取，未读取时需关闭连接"""
+
+    def __init__(self, status, message, body_read=False):
+        super().__init__(message)
+        self.status = status
+        self.body_read = body_read
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_pair(value, low, high):
+    return (isinstance(value, list) and len(value) == 2
+            and all(_is_int(v) and low <= v <= high for v in value))
+
+
+# X-Watermark-Config中允许的字段：字段 -> (检查函数, 要求说明)，与DEFAULT_WATERMARK_CONFIG的字段一致
+_CONFIG_CHECKS = {
+    'text': (lambda v: isinstance(v, str), "字符串"),
+    'font_size': (lambda v: _is_int(v) and 1 <= v <= 2000, "1-2000的整数"),
+    'font_color': (lambda v: isinstance(v, list) and len(v) == 3 and all(_is_int(c) and 0 <= c <= 255 for c in v),
+                   "[R, G, B]，每项为0-255的整数"),
+    'opacity': (lambda v: _is_number(v) and 0 <= v <= 100, "0-100的数字"),
+    'position': (lambda v: _is_pair(v, 0, 1_000_000), "[x, y]，每项为非负整数"),
+    'rotation': (lambda v: _is_number(v) and -360 <= v <= 360, "-360到360的数字"),
+    'tiled': (lambda v: isinstance(v, bool), "true或false"),
+    'tile_spacing': (lambda v: _is_int(v) and 0 <= v <= 10000, "0-10000的整数"),
+}
+
+def check_config_overrides(overrides):
+    """检查客户端给出的水印配置（JSON对象），有未知字段或取值不合法时抛出RequestError(400)"""
+    if not isinstance(overrides, dict):
+        raise RequestError(400, "X-Watermark-Config必须是JSON对象")
+    for key, value in overrides.items():
+        check = _CONFIG_CHECKS.get(key)
+        if check is None:
+            raise RequestError(400, f"X-Watermark-Config中有未知的字段: {key}")
+        valid, expected = check
+        if not valid(value):
+            raise RequestError(400, f"X-Watermark-Config中{key}的取值无效，应为{expected}")
+
+
+def sniff_extension(data):
+    """根据文件头判断原图格式，返回扩展名（无法识别时返回None）"""
+    for magic, ext in _MAGIC:
+        if data.startswith(magic):
+            return ext
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
+
+def warm_up(configs):
+    """工作进程初始化：忽略Ctrl+C（由主进程停止服务），SIGTERM恢复默认处理（只结束该工作进程），
+    用各模板渲染一次小图预热字体和图块缓存"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for config in configs:
+        try:
+            watermark_engine.render_watermark(Image.new('RGB', (64, 64)), config)
+        except Exception:
+            pass
+
+
+class WatermarkServer:
+    """HTTP水印服务
+
+    concurrency为同时进行水印计算的请求数（默认等于工作进程数），max_queue为额外允许
+    排队等待的请求数；都占满时新请求在读取请求体之前就返回503，不占用内存。
+    """
+
+    def __init__(self, templates, workers=None, concurrency=None, max_queue=None, threads=False,
+                 max_body=DEFAULT_MAX_BODY):
+        self.templates = {name: watermark_configs.freeze(watermark_engine.config_from_template(template))
+                          for name, template in templates.items()}
+        self.workers = workers or os.cpu_count() or 1
+        self.concurrency = concurrency or self.workers
+        self.max_queue = self.concurrency * 4 if max_queue is None else max_queue
+        self.threads = threads
+        self.max_body = max_body
+        self.executor = None
+        self.stats = {'active': 0, 'queued': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+        self._slots = None
+        self._started = time.time()
+
+    def start_executor(self):
+        """创建工作进程池（或线程池）"""
+        configs = list(self.templates.values())
+        if self.threads:
+            # 线程共享同一份缓存，预热一次即可
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            for config in configs:
+                self.executor.submit(watermark_engine.render_watermark, Image.new('RGB', (64, 64)), config)
+        else:
+            # 工作进程不从服务进程fork，不继承事件循环和信号处理；单个工作进程退出不会停止服务
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                initializer=warm_up, initargs=(configs,))
+
+    def _restart_executor(self, broken):
+        """工作进程异常退出后进程池不可再用，重新创建（多个请求同时发现时只重建一次）"""
+        if self.executor is not broken:
+            return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.start_executor()
+
+    async def serve(self, host='127.0.0.1', port=8080, on_ready=None):
+        """启动服务，直到收到SIGINT/SIGTERM"""
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self.start_executor()
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except (NotImplementedError, RuntimeError):  # Windows或非主线程
+                pass
+        if on_ready:
+            on_ready(server.sockets[0].getsockname())
+        async with server:
+            await stop.wait()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    async def _handle_connection(self, reader, writer):
+        """处理一个连接上的请求（支持HTTP/1.1长连接）"""
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                keep_alive = await self._handle_request(request_line, reader, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ValueError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _handle_request(self, request_line, reader, writer):
+        """处理一个请求，返回是否保持连接"""
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            await self._respond(writer, 400, self._error_body("请求行格式错误"), keep_alive=False)
+            return False
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        extra_headers = {}
+        try:
+            if url.path == '/health' and method == 'GET':
+                body = json.dumps(dict(self.stats, uptime=round(time.time() - self._started, 1),
+                                       concurrency=self.concurrency, max_queue=self.max_queue)).encode('utf-8')
+                await self._respond(writer, 200, body, 'application/json', keep_alive)
+                return keep_alive
+            if url.path != '/watermark':
+                raise RequestError(404, "未知的路径")
+            if method != 'POST':
+                raise RequestError(405, "只支持POST")
+            body, content_type = await self._watermark(query, headers, reader)
+        except RequestError as e:
+            if e.status == 503:
+                extra_headers['Retry-After'] = '1'
+            # 未读取的请求体无法跳过，关闭连接
+            keep_alive = keep_alive and (e.body_read or headers.get('content-length', '0') == '0')
+            await self._respond(writer, e.status, self._error_body(str(e)), 'application/json', keep_alive,
+                                extra_headers)
+            return keep_alive
+        await self._respond(writer, 200, body, content_type, keep_alive)
+        return keep_alive
+
+    async def _watermark(self, query, headers, reader):
+        """POST /watermark：排队、读取原图、在工作进程中添加水印，返回(图片数据, Content-Type)"""
+        config = self._request_config(query, headers)
+        try:
+            settings = watermark_engine.export_settings(
+                query.get('preset'), format=query.get('format'),
+                quality=int(query['quality']) if 'quality' in query else None)
+        except (KeyError, ValueError) as e:
+            raise RequestError(400, f"导出设置错误: {e}")
+        if settings['format'] is not None and settings['format'] not in watermark_engine.OUTPUT_FORMATS:
+            raise RequestError(400, f"不支持的输出格式: {settings['format']}")
+        if 'transfer-encoding' in headers or 'content-length' not in headers:
+            raise RequestError(411, "需要Content-Length")
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise RequestError(400, "Content-Length格式错误")
+        if length > self.max_body:
+            raise RequestError(413, f"请求体超过 {self.max_body} 字节")
+
+        # 背压：计算和排队的请求都已占满时，在读取请求体之前拒绝
+        if self.stats['active'] + self.stats['queued'] >= self.concurrency + self.max_queue:
+            self.stats['rejected'] += 1
+            raise RequestError(503, "服务繁忙，请稍后重试")
+        self.stats['queued'] += 1
+        try:
+            data = await reader.readexactly(length)
+            ext = sniff_extension(data)
+            if ext is None:
+                raise RequestError(400, "无法识别的图片格式", body_read=True)
+            if settings['format'] is not None:
+                ext = watermark_engine.OUTPUT_FORMATS[settings['format']]
+            await self._slots.acquire()
+        finally:
+            self.stats['queued'] -= 1
+
+        self.stats['active'] += 1
+        executor = self.executor
+        try:
+            loop = asyncio.get_running_loop()
+            encoded = await loop.run_in_executor(executor, watermark_engine.encode_watermarked,
+                                                 data, config, ext, settings)
+        except BrokenExecutor:
+            # 工作进程异常退出（如被系统结束）：重建进程池，客户端稍后重试
+            self.stats['failed'] += 1
+            self._restart_executor(executor)
+            raise RequestError(503, "工作进程异常退出，请稍后重试", body_read=True)
+        except (OSError, ValueError, SyntaxError) as e:
+            # 图片损坏或无法解码（Pillow对损坏的文件抛出OSError、ValueError或SyntaxError）
+            self.stats['failed'] += 1
+            raise RequestError(400, f"处理图片失败: {e}", body_read=True)
+        except Exception as e:
+            self.stats['failed'] += 1
+            raise RequestError(500, f"服务内部错误: {e}", body_read=True)
+        finally:
+            self.stats['active'] -= 1
+            self._slots.release()
+        self.stats['completed'] += 1
+        return encoded, _CONTENT_TYPES.get(ext, 'application/octet-stream')
+
+    def _request_config(self, query, headers):
+        """请求的水印配置：模板名称或请求头中的JSON配置"""
+        inline = headers.get('x-watermark-config')
+        if inline:
+            try:
+                # 请求头按latin-1解码，JSON中的中文按UTF-8发送
+                overrides = json.loads(inline.encode('latin-1').decode('utf-8'))
+            except ValueError as e:
+                raise RequestError(400, f"X-Watermark-Config不是有效的JSON: {e}")
+            check_config_overrides(overrides)
+            base = self.templates.get(query.get('template'), watermark_engine.DEFAULT_WATERMARK_CONFIG)
+            config = dict(base)
+            config.update(overrides)
+            return watermark_configs.freeze(config)
+        name = query.get('template')
+        if name is None:
+            raise RequestError(400, "需要template参数或X-Watermark-Config请求头")
+        if name not in self.templates:
+            raise RequestError(404, f"模板 '{name}' 不存在")
+        return self.templates[name]
+
+    @staticmethod
+    def _error_body(message):
+        return json.dumps({'error': message}, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    async def _respond(writer, status, body, content_type='application/json', keep_alive=True, extra_headers=None):
+        """写入响应"""
+        lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+                 f"Content-Type: {content_type}",
+                 f"Content-Length: {len(body)}",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        for name, value in (extra_headers or {}).items():
+            lines.append(f"{name}: {value}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
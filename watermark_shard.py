@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分片导出 - 把一次导出拆成多个分片放在共享文件夹中，多台机器（或多个进程）上的工作进程
+通过租约文件认领分片，共同完成导出
+
+任务文件夹结构：
+  job.json          任务说明：输出文件夹、导出设置、去重后的水印配置、分片数量
+  shards/NNNNN.json 分片：[(原图路径, 配置编号), ...]
+  leases/NNNNN.json 租约：正在处理该分片的工作进程，修改时间超过租约时长视为过期
+  done/NNNNN.json   完成记录：成功数量和失败列表
+
+各机器上的原图路径、输出文件夹路径必须相同（如挂载在同一位置的网络存储），时钟需要同步。
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+
+import watermark_configs
+import watermark_engine
+import watermark_pipeline
+
+JOB_FILENAME = "job.json"
+JOB_VERSION = 1
+# 默认每个分片的图片数量
+DEFAULT_SHARD_SIZE = 200
+# 默认租约时长（秒），工作进程每隔三分之一时长续约一次
+DEFAULT_LEASE_SECONDS = 60
+
+
+def _write_json(path, data):
+    """原子地写入JSON文件"""
+    watermark_pipeline.write_atomic(path, json.dumps(data, ensure_ascii=False).encode('utf-8'), fsync=True)
+
+
+def _read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _shard_name(index):
+    return f"{index:05d}.json"
+
+
+def create_job(job_dir, items, output_folder, settings=None, shard_size=DEFAULT_SHARD_SIZE):
+    """创建分片导出任务
+
+    items为[(原图路径, 水印配置), ...]；相同的配置对象（如共享的模板）只保存一份。
+    返回分片数量。
+    """
+    settings = dict(settings or watermark_engine.DEFAULT_EXPORT_SETTINGS)
+    for name in ('shards', 'leases', 'done'):
+        os.makedirs(os.path.join(job_dir, name), exist_ok=True)
+
+    configs = []
+    config_ids = {}
+    shard = []
+    shard_count = 0
+    for img_path, config in items:
+        cached = config_ids.get(id(config))
+        if cached is None:
+            # 保存配置的引用，保证id不被复用
+            cached = config_ids[id(config)] = (config, len(configs))
+            configs.append(dict(config))
+        config_id = cached[1]
+        shard.append((os.path.abspath(img_path), config_id))
+        if len(shard) >= shard_size:
+            _write_json(os.path.join(job_dir, 'shards', _shard_name(shard_count)), shard)
+            shard_count += 1
+            shard = []
+    if shard:
+        _write_json(os.path.join(job_dir, 'shards', _shard_name(shard_count)), shard)
+        shard_count += 1
+
+    # 最后写入任务说明，工作进程看到job.json时所有分片都已就绪
+    _write_json(os.path.join(job_dir, JOB_FILENAME), {
+        'version': JOB_VERSION,
+        'output_folder': os.path.abspath(output_folder),
+        'settings': settings,
+        'configs': configs,
+        'shards': shard_count,
+    })
+    return shard_count
+
+
+def load_job(job_dir):
+    """读取任务说明，水印配置转换为只读配置"""
+    job = _read_json(os.path.join(job_dir, JOB_FILENAME))
+    if job.get('version') != JOB_VERSION:
+        raise ValueError(f"不支持的任务版本: {job.get('version')}")
+    job['configs'] = [watermark_configs.freeze(config) for config in job['configs']]
+    return job
+
+
+def job_status(job_dir, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """任务进度：{'shards', 'done', 'leased', 'pending', 'succeeded', 'failed'}"""
+    job = _read_json(os.path.join(job_dir, JOB_FILENAME))
+    status = {'shards': job['shards'], 'done': 0, 'leased': 0, 'pending': 0, 'succeeded': 0, 'failed': 0}
+    now = time.time()
+    for index in range(job['shards']):
+        name = _shard_name(index)
+        try:
+            done = _read_json(os.path.join(job_dir, 'done', name))
+        except OSError:
+            try:
+                leased = now - os.stat(os.path.join(job_dir, 'leases', name)).st_mtime < lease_seconds
+            except OSError:
+                leased = False
+            status['leased' if leased else 'pending'] += 1
+            continue
+        status['done'] += 1
+        status['succeeded'] += done['succeeded']
+        status['failed'] += len(done['failed'])
+    return status
+
+
+class Lease:
+    """分片租约
+
+    用O_EXCL创建租约文件认领分片；持有期间由后台线程定期更新修改时间。
+    过期的租约先改名再重新创建。多个工作进程同时回收时，后改名的一方可能拿到其他
+    工作进程刚创建的新租约，此时检查其修改时间发现未过期，放回原处并放弃认领。
+    放回之前的短暂间隙中仍可能有两个工作进程都认为自己持有租约，续约时发现
+    租约不属于自己的一方设置lost并放弃该分片，因此同一分片最终只有一个工作进程完成。
+    """
+
+    def __init__(self, path, worker_id, lease_seconds):
+        self.path = path
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        """尝试认领，成功时开始续约并返回True"""
+        if not self._create():
+            try:
+                age = time.time() - os.stat(self.path).st_mtime
+            except FileNotFoundError:
+                age = None
+            except OSError:
+                return False
+            if age is not None:
+                if age < self.lease_seconds:
+                    return False
+                # 租约过期（工作进程崩溃或失联）：改名后重新认领
+                stale_path = f"{self.path}.stale-{self.worker_id}"
+                try:
+                    os.rename(self.path, stale_path)
+                except OSError:
+                    return False
+                if not self._reclaimed(stale_path):
+                    return False
+            if not self._create():
+                return False
+        self._thread = threading.Thread(target=self._renew, name="shard-lease", daemon=True)
+        self._thread.start()
+        return True
+
+    def _reclaimed(self, stale_path):
+        """检查改名得到的租约确实已过期并删除；若是其他工作进程刚回收后创建的新租约，放回原处"""
+        try:
+            expired = time.time() - os.stat(stale_path).st_mtime >= self.lease_seconds
+        except OSError:
+            return False
+        if not expired:
+            try:
+                # link不会覆盖已存在的租约（期间可能又有工作进程创建了租约）
+                os.link(stale_path, self.path)
+            except OSError:
+                pass
+        os.remove(stale_path)
+        return expired
+
+    def _create(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'worker': self.worker_id, 'acquired': time.time()}, f)
+        return True
+
+    def _renew(self):
+        """定期续约；租约被其他工作进程回收时设置lost"""
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                if _read_json(self.path).get('worker') != self.worker_id:
+                    raise OSError("租约已被回收")
+                os.utime(self.path)
+            except (OSError, ValueError):
+                self.lost.set()
+                return
+
+    def release(self):
+        """停止续约并删除租约文件（仍由自己持有时）"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if not self.lost.is_set():
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class ShardWorker:
+    """分片导出工作进程
+
+    依次认领未完成的分片，使用与图形界面导出相同的流水线渲染和写入；其他工作进程
+    持有的分片等待其完成或租约过期。所有分片完成后返回。
+    """
+
+    def __init__(self, job_dir, cpu_workers=None, cpu_executor=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 poll_interval=None, worker_id=None, log=print):
+        self.job_dir = job_dir
+        self.job = load_job(job_dir)
+        self.cpu_workers = cpu_workers
+        self.cpu_executor = cpu_executor
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval or max(1.0, lease_seconds / 6)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.log = log
+
+    def _path(self, folder, index):
+        return os.path.join(self.job_dir, folder, _shard_name(index))
+
+    def run(self):
+        """处理分片直到任务全部完成，返回本进程完成的(分片数, 成功数, 失败数)"""
+        os.makedirs(self.job['output_folder'], exist_ok=True)
+        shards = succeeded = failed = 0
+        remaining = [index for index in range(self.job['shards'])
+                     if not os.path.exists(self._path('done', index))]
+        while remaining:
+            claimed = False
+            for index in list(remaining):
+                if os.path.exists(self._path('done', index)):
+                    remaining.remove(index)
+                    continue
+                lease = Lease(self._path('leases', index), self.worker_id, self.lease_seconds)
+                if not lease.acquire():
+                    continue
+                claimed = True
+                try:
+                    # 认领后再次检查：可能在检查和认领之间被其他工作进程完成
+                    if os.path.exists(self._path('done', index)):
+                        remaining.remove(index)
+                        continue
+                    result = self.run_shard(index, lease.lost)
+                finally:
+                    lease.release()
+                if result is not None:
+                    remaining.remove(index)
+                    shards += 1
+                    succeeded += result['succeeded']
+                    failed += len(result['failed'])
+            if remaining and not claimed:
+                # 剩下的分片都在其他工作进程手中，等待完成或租约过期
+                time.sleep(self.poll_interval)
+        # 清理崩溃的工作进程留下的临时文件
+        watermark_pipeline.remove_partial_outputs(self.job['output_folder'], older_than=self.lease_seconds)
+        return shards, succeeded, failed
+
+    def run_shard(self, index, cancel_event):
+        """导出一个分片并写入完成记录；租约丢失时放弃（返回None）"""
+        shard = _read_json(self._path('shards', index))
+        configs = self.job['configs']
+        failures = []
+
+        def on_done(_, img_path, output_path, error):
+            if error is not None:
+                failures.append((img_path, error))
+
+        pipeline = watermark_pipeline.ExportPipeline(self.job['output_folder'], settings=self.job['settings'],
+                                                     cpu_workers=self.cpu_workers, cpu_executor=self.cpu_executor,
+                                                     fsync=True)
+        start_time = time.time()
+        done, _ = pipeline.run(((img_path, configs[config_id], None) for img_path, config_id in shard),
+                               on_done=on_done, cancel_event=cancel_event)
+        if cancel_event.is_set():
+            self.log(f"⚠️  分片 {index} 的租约已被回收，放弃该分片")
+            return None
+        result = {'worker': self.worker_id, 'succeeded': done, 'failed': failures,
+                  'elapsed': time.time() - start_time}
+        _write_json(self._path('done', index), result)
+        self.log(f"分片 {index + 1}/{self.job['shards']}: {done} 张成功, {len(failures)} 张失败"
+                 f" ({result['elapsed']:.1f} 秒)")
+        return result
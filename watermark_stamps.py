@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+水印印章缓存 - 预先渲染旋转后的水印图块，在批量导出和预览中重复使用
+"""
+
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw
+
+import watermark_fonts
+import watermark_trace
+
+# 文字四周的留白（像素），与旋转前的临时图片保持一致
+STAMP_PADDING = 10
+
+
+class Stamp:
+    """渲染好的水印图块
+
+    image为旋转后的RGBA图块，mask为其alpha通道（已包含透明度），
+    offset为文字相对绘制起点的偏移，用于未旋转时与直接绘制文字对齐。
+    """
+
+    __slots__ = ('image', 'mask', 'color', 'text_width', 'text_height', 'offset', 'nbytes')
+
+    def __init__(self, image, color, text_width, text_height, offset):
+        self.image = image
+        self.mask = image.getchannel('A')
+        self.color = color
+        self.text_width = text_width
+        self.text_height = text_height
+        self.offset = offset
+        self.nbytes = image.width * image.height * 5
+
+
+def render_stamp(text, font, color, rotation):
+    """渲染文字并围绕中心旋转，返回Stamp"""
+    # 先获取文字边界框
+    measure_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    bbox = measure_draw.textbbox((0, 0), text, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+
+    # 创建只包含文字的临时图片，文字边界框放在留白之内，避免大字号时被裁切
+    with watermark_trace.span("stamp.rasterize", width=text_width, height=text_height):
+        temp_img = Image.new('RGBA', (text_width + STAMP_PADDING * 2, text_height + STAMP_PADDING * 2), (0, 0, 0, 0))
+        temp_draw = ImageDraw.Draw(temp_img)
+        temp_draw.text((STAMP_PADDING - bbox[0], STAMP_PADDING - bbox[1]), text, font=font, fill=color)
+
+    # 围绕文字中心旋转
+    if rotation:
+        with watermark_trace.span("stamp.rotate", angle=rotation):
+            rotated = temp_img.rotate(rotation, expand=True)
+    else:
+        rotated = temp_img
+    return Stamp(rotated, color, text_width, text_height, (bbox[0], bbox[1]))
+
+
+class StampCache:
+    """水印图块缓存
+
+    以(文本, 字体, 字号, 颜色, 透明度, 旋转角度)为键，按图块占用的内存字节数
+    做LRU淘汰。返回的图块在多个线程和多张图片间共享，调用方只能读取不能修改。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, font_resolver=None):
+        self.max_bytes = max_bytes
+        self.font_resolver = font_resolver or watermark_fonts.default_resolver
+        self._lock = threading.Lock()
+        self._stamps = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_stamp(self, text, font_size, font_color, opacity, rotation):
+        """获取水印图块，未命中时渲染并放入缓存"""
+        font_size = max(1, int(font_size))
+        font_path = self.font_resolver.resolve_path()
+        alpha = int(255 * opacity / 100)
+        color = (*font_color, alpha)
+        key = (text, font_path, font_size, color, rotation)
+
+        with self._lock:
+            stamp = self._stamps.get(key)
+            if stamp is not None:
+                self._stamps.move_to_end(key)
+                self.hits += 1
+                watermark_trace.count("stamp.cache_hit")
+                return stamp
+            self.misses += 1
+
+        font = self.font_resolver.get_font(font_size)
+        stamp = render_stamp(text, font, color, rotation)
+
+        # 单个图块超过上限时不缓存
+        if stamp.nbytes > self.max_bytes:
+            return stamp
+
+        with self._lock:
+            if key not in self._stamps:
+                self._stamps[key] = stamp
+                self.current_bytes += stamp.nbytes
+                while self.current_bytes > self.max_bytes:
+                    _, evicted = self._stamps.popitem(last=False)
+                    self.current_bytes -= evicted.nbytes
+                    self.evictions += 1
+        return stamp
+
+    def stats(self):
+        """返回缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'cached_stamps': len(self._stamps),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def clear(self):
+        """清空缓存和统计"""
+        with self._lock:
+            self._stamps.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+# 全局共享的图块缓存
+default_cache = StampCache()
+
+
+def get_stamp(text, font_size, font_color, opacity, rotation):
+    """使用全局缓存获取水印图块"""
+    return default_cache.get_stamp(text, font_size, font_color, opacity, rotation)
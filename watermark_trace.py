@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能追踪 - 轻量的计时区段和计数器，默认关闭，通过环境变量启用
+
+设置环境变量 WATERMARK_TRACE=trace.json 后，各处理阶段（字体加载、缩放、文字栅格化、
+旋转、合成、编码、写入等）的耗时以Chrome追踪格式追加到该文件，可在chrome://tracing
+或 https://ui.perfetto.dev 中查看。多个进程可以写入同一文件。
+汇总统计：python watermark_trace.py trace.json
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import argparse
+import threading
+import multiprocessing.util
+
+# 启用追踪的环境变量（值为追踪文件路径）
+TRACE_ENV = "WATERMARK_TRACE"
+
+# 缓冲的事件数量达到该值时写入文件
+FLUSH_EVENTS = 2000
+
+
+class _NullSpan:
+    """追踪关闭时使用的空区段"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """计时区段，结束时记录为一个完整事件"""
+
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.tracer.record(self.name, self.start, end - self.start, self.args)
+        return False
+
+    def set(self, **args):
+        """补充区段参数（如处理结果的尺寸）"""
+        self.args.update(args)
+
+
+class Tracer:
+    """追踪记录器
+
+    事件先缓冲在内存中，达到FLUSH_EVENTS或进程退出时以Chrome追踪的JSON数组格式
+    追加到文件（数组可以不闭合），每次写入为一次追加调用，多个进程可共用一个文件。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._events = []
+        self._counters = {}
+        self._origin = time.perf_counter() - time.time()
+        self.pid = os.getpid()
+
+    def _timestamp(self, perf_time):
+        """perf_counter时间换算为微秒级的Unix时间戳，使不同进程的事件对齐"""
+        return (perf_time - self._origin) * 1e6
+
+    def span(self, name, **args):
+        """创建计时区段"""
+        return Span(self, name, args)
+
+    def record(self, name, start, duration, args=None):
+        """记录一个已完成的区段（start为perf_counter时间，duration单位秒）"""
+        event = {
+            'name': name, 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident(),
+            'ts': round(self._timestamp(start), 1), 'dur': round(duration * 1e6, 1),
+        }
+        if args:
+            event['args'] = args
+        self._append(event)
+
+    def event(self, name, **args):
+        """记录一个瞬时事件（用于替代调试输出）"""
+        event = {
+            'name': name, 'ph': 'i', 's': 't', 'pid': self.pid, 'tid': threading.get_ident(),
+            'ts': round(self._timestamp(time.perf_counter()), 1),
+        }
+        if args:
+            event['args'] = args
+        self._append(event)
+
+    def count(self, name, value=1):
+        """累加计数器，记录为计数器事件"""
+        with self._lock:
+            total = self._counters.get(name, 0) + value
+            self._counters[name] = total
+        self._append({
+            'name': name, 'ph': 'C', 'pid': self.pid,
+            'ts': round(self._timestamp(time.perf_counter()), 1), 'args': {'value': total},
+        })
+
+    def _append(self, event):
+        with self._lock:
+            self._events.append(event)
+            full = len(self._events) >= FLUSH_EVENTS
+        if full:
+            self.flush()
+
+    def flush(self):
+        """把缓冲的事件追加到追踪文件"""
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return
+        data = ''.join(json.dumps(event, ensure_ascii=False) + ",\n" for event in events)
+        try:
+            # 由第一个写入的进程写入数组开头
+            with open(self.path, 'x', encoding='utf-8') as f:
+                f.write("[\n")
+        except FileExistsError:
+            pass
+        except OSError:
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, data.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def _after_fork(self):
+        """fork出的子进程丢弃父进程的缓冲，重新注册退出时写入"""
+        self._lock = threading.Lock()
+        self._events = []
+        self._counters = {}
+        self.pid = os.getpid()
+        _register_flush(self)
+
+
+def _register_flush(tracer):
+    """进程退出时写入剩余事件（multiprocessing子进程退出时不执行atexit）"""
+    atexit.register(tracer.flush)
+    multiprocessing.util.Finalize(tracer, tracer.flush, exitpriority=100)
+
+
+def _create_tracer():
+    path = os.environ.get(TRACE_ENV)
+    if not path:
+        return None
+    tracer = Tracer(os.path.abspath(path))
+    _register_flush(tracer)
+    multiprocessing.util.register_after_fork(tracer, Tracer._after_fork)
+    return tracer
+
+
+# 全局追踪记录器，未启用时为None
+tracer = _create_tracer()
+enabled = tracer is not None
+
+
+def span(name, **args):
+    """计时区段：with watermark_trace.span("encode", format="JPEG"): ..."""
+    if tracer is None:
+        return _NULL_SPAN
+    return tracer.span(name, **args)
+
+
+def event(name, **args):
+    """瞬时事件"""
+    if tracer is not None:
+        tracer.event(name, **args)
+
+
+def count(name, value=1):
+    """计数器"""
+    if tracer is not None:
+        tracer.count(name, value)
+
+
+def flush():
+    """立即写入缓冲的事件"""
+    if tracer is not None:
+        tracer.flush()
+
+
+def load_trace(path):
+    """读取追踪文件（兼容未闭合的数组），返回事件列表"""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.endswith(','):
+        text = text[:-1]
+    if not text.endswith(']'):
+        text += ']'
+    return json.loads(text)
+
+
+def summarize(events):
+    """按名称汇总区段耗时（毫秒）和计数器最终值"""
+    durations = {}
+    counters = {}
+    for event in events:
+        if event.get('ph') == 'X':
+            durations.setdefault(event['name'], []).append(event['dur'] / 1000)
+        elif event.get('ph') == 'C':
+            key = (event['name'], event['pid'])
+            counters[key] = event['args']['value']
+
+    spans = {}
+    for name, values in durations.items():
+        values.sort()
+        spans[name] = {
+            'count': len(values),
+            'total_ms': round(sum(values), 3),
+            'mean_ms': round(sum(values) / len(values), 3),
+            'p50_ms': round(values[len(values) // 2], 3),
+            'p99_ms': round(values[min(len(values) - 1, int(len(values) * 0.99))], 3),
+            'max_ms': round(values[-1], 3),
+        }
+    totals = {}
+    for (name, _), value in counters.items():
+        totals[name] = totals.get(name, 0) + value
+    return {'spans': spans, 'counters': totals}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="汇总性能追踪文件")
+    parser.add_argument("trace", help=f"追踪文件（通过环境变量{TRACE_ENV}生成）")
+    args = parser.parse_args(argv)
+    json.dump(summarize(load_trace(args.trace)), sys.stdout, ensure_ascii=False, indent=2)
+    print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+监视文件夹 - 持续监视输入文件夹，新增或修改的图片写完后立即添加水印并导出
+
+Linux上通过inotify（ctypes调用libc，无需额外依赖）接收文件事件，其他系统或inotify不可用时
+定期扫描文件夹。图片经过与"导出所有图片"相同的流水线处理，导出清单和导出日志记录
+已处理的图片，重启后只处理期间新增或修改的图片。
+"""
+
+import os
+import sys
+import time
+import queue
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+
+import watermark_engine
+import watermark_manifest
+import watermark_pipeline
+import watermark_scan
+
+# 文件大小和修改时间保持不变多久后视为写入完成（秒，用于定期扫描和启动时已有的文件）
+DEFAULT_SETTLE_SECONDS = 1.0
+# inotify下只收到修改事件、迟迟没有关闭事件的文件，保持不变多久后仍然处理（秒）
+DEFAULT_WRITE_TIMEOUT = 60.0
+# 定期扫描的间隔（秒）
+DEFAULT_POLL_INTERVAL = 1.0
+# 上传软件常用的临时文件后缀，这些文件改名为最终文件名后才处理
+TEMP_SUFFIXES = ('.part', '.tmp', '.crdownload', '.filepart', watermark_pipeline.PARTIAL_SUFFIX)
+
+# inotify事件（见inotify(7)）
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_candidate(path):
+    """是否为需要处理的图片（跳过隐藏文件和上传中的临时文件）"""
+    name = os.path.basename(path)
+    if name.startswith('.') or name.lower().endswith(TEMP_SUFFIXES):
+        return False
+    return name.lower().endswith(watermark_engine.SUPPORTED_FORMATS)
+
+
+def _file_signature(path):
+    """文件大小和修改时间，文件不存在时返回None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class InotifyWatcher:
+    """基于inotify的文件夹监视
+
+    poll()返回[(路径, 是否已写完)]：关闭写入（IN_CLOSE_WRITE）和移入（IN_MOVED_TO）的文件
+    为True；只有创建或修改事件的文件为False，写入方可能仍打开着文件，应等待关闭事件；
+    新建子文件夹中加入监视前已有的文件为None，需要等待大小稳定。
+    事件队列溢出时返回None，调用方应重新扫描。
+    """
+
+    def __init__(self, folder, recursive=True):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1失败")
+        self.recursive = recursive
+        self._dirs = {}
+        self._add_watch(folder)
+        if recursive:
+            for root, dirs, _ in os.walk(folder):
+                for name in dirs:
+                    self._add_watch(os.path.join(root, name))
+
+    def _add_watch(self, folder):
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"无法监视文件夹: {folder}")
+        self._dirs[wd] = folder
+
+    def poll(self, timeout):
+        """等待最多timeout秒，返回这段时间内的文件事件"""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            folder = self._dirs.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    # 新建的子文件夹：加入监视，并报告其中已有的文件（加入监视前可能已写入，
+                    # 移入的文件夹中的文件已写完）
+                    try:
+                        self._add_watch(path)
+                    except OSError:
+                        continue
+                    complete = True if mask & IN_MOVED_TO else None
+                    events.extend((file_path, complete) for file_path in watermark_scan.iter_image_files(path))
+                continue
+            events.append((path, bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """定期扫描文件夹，比较文件大小和修改时间
+
+    只保存文件夹中现有文件的大小和修改时间，删除的文件同时从记录中删除。
+    无法得知文件是否已关闭，poll()返回的文件都为None（需要等待大小稳定）。
+    """
+
+    def __init__(self, folder, recursive=True, interval=DEFAULT_POLL_INTERVAL):
+        self.folder = folder
+        self.recursive = recursive
+        self.interval = interval
+        self._known = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self):
+        known = {}
+        for path in watermark_scan.iter_image_files(self.folder, self.recursive):
+            signature = _file_signature(path)
+            if signature is not None:
+                known[path] = signature
+        return known
+
+    def poll(self, timeout):
+        """等待到下一次扫描（最多timeout秒），返回有变化的文件"""
+        delay = self._next_scan - time.monotonic()
+        if delay > 0:
+            time.sleep(min(delay, timeout))
+            if delay > timeout:
+                return []
+        self._next_scan = time.monotonic() + self.interval
+        known = self._scan()
+        changed = [(path, None) for path, signature in known.items() if self._known.get(path) != signature]
+        self._known = known
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(folder, recursive=True, polling=False, interval=DEFAULT_POLL_INTERVAL):
+    """Linux上优先使用inotify，不可用时定期扫描"""
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(folder, recursive)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(folder, recursive, interval)
+
+
+class WatchService:
+    """监视文件夹并持续导出
+
+    监视线程收集文件事件，等待文件写完后放入任务队列；流水线（读取、渲染、写入）在
+    调用run()的线程中持续运行，直到stop()。
+    回调on_done(原图路径, 输出路径或None, 错误信息或None, 延迟秒数)在run()的线程中调用，
+    延迟从发现文件写完到输出写入完成。
+    """
+
+    def __init__(self, input_folder, output_folder, config, settings=None, cpu_workers=None,
+                 cpu_executor=None, recursive=True, polling=False, poll_interval=DEFAULT_POLL_INTERVAL,
+                 settle_seconds=DEFAULT_SETTLE_SECONDS, write_timeout=DEFAULT_WRITE_TIMEOUT):
+        self.input_folder = os.path.abspath(input_folder)
+        self.output_folder = os.path.abspath(output_folder)
+        self.config = config
+        self.settings = dict(settings or watermark_engine.DEFAULT_EXPORT_SETTINGS)
+        self.cpu_workers = cpu_workers
+        self.cpu_executor = cpu_executor
+        self.recursive = recursive
+        self.settle_seconds = settle_seconds
+        self.write_timeout = write_timeout
+        self.watcher = create_watcher(self.input_folder, recursive, polling, poll_interval)
+        self._cfg_hashes = {}  # 输出扩展名 -> 配置哈希
+        self._tasks = queue.Queue()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._settling = {}  # 路径 -> (大小和修改时间, 开始稳定的时间, 需要稳定的秒数)
+        self._in_flight = set()
+        self._manifest = None
+
+    @property
+    def polling(self):
+        """是否使用定期扫描（而不是inotify）"""
+        return isinstance(self.watcher, PollingWatcher)
+
+    def stop(self):
+        """停止监视，已开始处理的图片完成后run()返回"""
+        self._stop.set()
+
+    def run(self, on_done=None):
+        """开始监视，阻塞直到stop()；返回(成功数量, 失败数量)"""
+        os.makedirs(self.output_folder, exist_ok=True)
+        watermark_pipeline.remove_partial_outputs(self.output_folder)
+        self._manifest = watermark_manifest.ExportManifest(self.output_folder)
+        self._manifest.begin_run(settings=self.settings, watch=self.input_folder)
+        watcher_thread = threading.Thread(target=self._watch, name="watch", daemon=True)
+        watcher_thread.start()
+
+        def on_pipeline_done(task, img_path, output_path, error):
+            detected, cfg_hash, fingerprint = task
+            with self._lock:
+                self._in_flight.discard(img_path)
+                if error is None:
+                    self._manifest.record(img_path, output_path, cfg_hash, fingerprint)
+            if on_done:
+                on_done(img_path, output_path, error, time.monotonic() - detected)
+
+        pipeline = watermark_pipeline.ExportPipeline(self.output_folder, settings=self.settings,
+                                                     cpu_workers=self.cpu_workers,
+                                                     cpu_executor=self.cpu_executor, fsync=True)
+        try:
+            return pipeline.run(self._task_iter(), on_done=on_pipeline_done)
+        finally:
+            self._stop.set()
+            watcher_thread.join()
+            self.watcher.close()
+            self._manifest.finish()
+
+    def _task_iter(self):
+        """把任务队列转换为流水线的任务序列，直到收到结束标记"""
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            yield task
+
+    def _watch(self):
+        """监视线程：先处理已有的图片，之后处理文件事件"""
+        try:
+            for path in watermark_scan.iter_image_files(self.input_folder, self.recursive):
+                if self._stop.is_set():
+                    break
+                # 刚修改过的文件可能仍在写入，等待稳定后再处理
+                signature = _file_signature(path)
+                if signature is not None and time.time() - signature[1] / 1e9 < self.settle_seconds:
+                    self._settle(path, self.settle_seconds)
+                else:
+                    self._submit(path)
+            while not self._stop.is_set():
+                # 有等待稳定的文件时缩短等待时间，稳定后尽快开始处理
+                timeout = min(0.05, self.settle_seconds) if self._settling else 0.5
+                events = self.watcher.poll(timeout)
+                if events is None:
+                    # 事件队列溢出：重新扫描整个文件夹
+                    events = [(path, None) for path in
+                              watermark_scan.iter_image_files(self.input_folder, self.recursive)]
+                for path, complete in events:
+                    if not is_candidate(path):
+                        continue
+                    if complete:
+                        self._settling.pop(path, None)
+                        self._submit(path)
+                    elif complete is None:
+                        self._settle(path, self.settle_seconds)
+                    else:
+                        # 写入方可能仍打开着文件（如暂停后继续写入），等待关闭事件；
+                        # 长时间没有关闭事件且没有变化时才按大小稳定处理
+                        self._settle(path, self.write_timeout)
+                self._check_settling()
+        finally:
+            self._tasks.put(None)
+
+    def _settle(self, path, seconds):
+        """等待文件的大小和修改时间保持seconds秒不变；已在等待的文件保留较长的等待时间"""
+        previous = self._settling.get(path)
+        if previous is not None:
+            seconds = max(seconds, previous[2])
+        self._settling[path] = (_file_signature(path), time.monotonic(), seconds)
+
+    def _check_settling(self):
+        """大小和修改时间保持不变达到要求秒数的文件视为写完"""
+        now = time.monotonic()
+        for path, (signature, since, seconds) in list(self._settling.items()):
+            current = _file_signature(path)
+            if current is None:
+                del self._settling[path]
+            elif current != signature:
+                self._settling[path] = (current, now, seconds)
+            elif now - since >= seconds:
+                del self._settling[path]
+                self._submit(path)
+
+    def _submit(self, path):
+        """把写完的图片放入任务队列；正在处理中的图片稍后再检查，输出已是最新的图片跳过"""
+        if not is_candidate(path) or path.startswith(self.output_folder + os.sep):
+            return
+        with self._lock:
+            if path in self._in_flight:
+                self._settle(path, self.settle_seconds)
+                return
+            output_path = watermark_engine.output_path_for(path, self.output_folder,
+                                                           output_format=self.settings['format'])
+            cfg_hash = self._cfg_hash(output_path)
+            if self._manifest.is_up_to_date(path, output_path, cfg_hash):
+                return
+            try:
+                fingerprint = watermark_manifest.source_fingerprint(path)
+            except OSError:
+                return
+            self._in_flight.add(path)
+        self._tasks.put((path, self.config, (time.monotonic(), cfg_hash, fingerprint)))
+
+    def _cfg_hash(self, output_path):
+        """输出文件的配置哈希（保持原图格式时各扩展名不同）"""
+        ext = os.path.splitext(output_path)[1].lower()
+        cfg_hash = self._cfg_hashes.get(ext)
+        if cfg_hash is None:
+            cfg_hash = self._cfg_hashes[ext] = watermark_manifest.output_config_hash(
+                self.config, self.settings, output_path)
+        return cfg_hash